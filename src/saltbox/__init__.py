@@ -1,14 +1,31 @@
 # -*- coding: utf-8 -*-
-from pkg_resources import DistributionNotFound, get_distribution
-
 from . import utils  # noqa
-from .api import SaltBox, SaltBoxConfig  # noqa
-from . import utils
-try:
-    # Change here if project is renamed and does not equal the package name
-    dist_name = __name__
-    __version__ = get_distribution(dist_name).version
-except DistributionNotFound:
-    __version__ = "unknown"
-finally:
-    del get_distribution, DistributionNotFound
+
+_API_NAMES = ("SaltBox", "SaltBoxConfig")
+
+
+def _version():
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        # Change here if project is renamed and does not equal the package name
+        return version(__name__)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def __getattr__(name):
+    # keep `import saltbox` cheap for the CLI; the API is loaded on first use
+    if name in _API_NAMES:
+        from . import api
+
+        return getattr(api, name)
+    if name == "__version__":
+        global __version__
+        __version__ = _version()
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_API_NAMES) + ["__version__"])
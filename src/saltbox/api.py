@@ -1,22 +1,36 @@
+import asyncio
+import collections
 import contextlib
-import hashlib
+import json
 import logging
 import os
-import shlex
-import shutil
+import selectors
+import sqlite3
 import subprocess
 import sys
 import tempfile
+import time
 import types
-from filelock import FileLock
-import salt
 
-from .salt_helpers import SaltMaster, SaltMinion
-from .template import RecipeTemplate
+from .salt_helpers import (
+    DaemonSupervisor,
+    PortAllocator,
+    SaltConfig,
+    SaltMaster,
+    SaltMinion,
+)
+from .store import ContentStore
+from .template import (
+    GenerationStore,
+    RecipeTemplate,
+    RenderManifest,
+    TemplateIndex,
+)
+from .worker import WorkerClient
 
 HERE = os.path.dirname(__file__)
-RSYNC = shutil.which("rsync")
 LOG = logging.getLogger(__name__)
+TERMINATE_GRACE = 10
 
 
 def call(arg_list):
@@ -25,51 +39,264 @@ def call(arg_list):
 
 
 def run(arg_list, capture_output=False):
+    LOG.debug(f"RUN {arg_list}")
+    return subprocess.run(arg_list, capture_output=capture_output)
+
+
+async def _terminate_async(proc, grace):
+    if proc.returncode is not None:
+        return
+    proc.terminate()
+    try:
+        await asyncio.wait_for(proc.wait(), grace)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+async def _communicate_async(proc, timeout, grace):
+    try:
+        return await asyncio.wait_for(proc.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        await asyncio.shield(_terminate_async(proc, grace))
+        raise
+
+
+async def call_async(arg_list, timeout=None, grace=None):
+    LOG.debug(f"CALL {arg_list}")
+    proc = await asyncio.create_subprocess_exec(*arg_list)
+    await _communicate_async(proc, timeout, grace or TERMINATE_GRACE)
+    return proc.returncode
+
+
+async def run_async(arg_list, capture_output=False, timeout=None, grace=None):
     LOG.debug(f"RUN {arg_list}")
     kwargs = {}
-    kwargs['stdout'] = subprocess.PIPE
-    kwargs['stderr'] = subprocess.PIPE
-    return subprocess.run(arg_list, **kwargs)
+    if capture_output:
+        kwargs['stdout'] = asyncio.subprocess.PIPE
+        kwargs['stderr'] = asyncio.subprocess.PIPE
+    proc = await asyncio.create_subprocess_exec(*arg_list, **kwargs)
+    stdout, stderr = await _communicate_async(proc, timeout, grace or TERMINATE_GRACE)
+    return subprocess.CompletedProcess(arg_list, proc.returncode, stdout, stderr)
+
+
+def stream(arg_list, **dargs):
+    LOG.debug(f"STREAM {arg_list}")
+    return OutputStream(arg_list, **dargs)
+
+
+class OutputStream(contextlib.AbstractContextManager):
+    STREAMS = ("stdout", "stderr")
+    CHUNK_SIZE = 64 * 1024
+    MAX_LINE = 1024 * 1024
+    MAX_MEMORY = 8 * 1024 * 1024
+
+    def __init__(self, arg_list, on_stdout=None, on_stderr=None, capture=True,
+                 lines=True, max_memory=None):
+        self._arg_list = arg_list
+        self._callbacks = {"stdout": on_stdout, "stderr": on_stderr}
+        self._lines = lines
+        self._spools = {}
+        if capture:
+            max_memory = self.MAX_MEMORY if max_memory is None else max_memory
+            self._spools = {
+                name: tempfile.SpooledTemporaryFile(max_size=max_memory)
+                for name in self.STREAMS
+            }
+        self._proc = None
+        self.returncode = None
+
+    @property
+    def args(self):
+        return self._arg_list
+
+    @property
+    def stdout(self):
+        return self._spools.get("stdout")
+
+    @property
+    def stderr(self):
+        return self._spools.get("stderr")
+
+    def __iter__(self):
+        assert self._proc is None, "OutputStream can only be consumed once"
+        self._proc = subprocess.Popen(
+            self._arg_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        pending = {name: b"" for name in self.STREAMS}
+        with selectors.DefaultSelector() as selector:
+            for name in self.STREAMS:
+                selector.register(getattr(self._proc, name), selectors.EVENT_READ, name)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    name = key.data
+                    data = os.read(key.fd, self.CHUNK_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        if pending[name]:
+                            yield self._emit(name, pending[name])
+                        continue
+                    if not self._lines:
+                        yield self._emit(name, data)
+                        continue
+                    *complete, pending[name] = (pending[name] + data).split(b"\n")
+                    for line in complete:
+                        yield self._emit(name, line + b"\n")
+                    if len(pending[name]) >= self.MAX_LINE:
+                        yield self._emit(name, pending[name])
+                        pending[name] = b""
+        self.returncode = self._proc.wait()
+        for spool in self._spools.values():
+            spool.seek(0)
+
+    def _emit(self, name, data):
+        if name in self._spools:
+            self._spools[name].write(data)
+        if self._callbacks[name] is not None:
+            self._callbacks[name](data)
+        return name, data
+
+    def wait(self):
+        if self.returncode is None:
+            for _ in self:
+                pass
+        return self.returncode
+
+    def __exit__(self, *args, **dargs):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        for spool in self._spools.values():
+            spool.close()
 
 
 class Registry:
-    def __init__(self, template_roots):
-        self._template_roots = template_roots
+    LEGACY_SUFFIX = ".txt"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS roots (
+            position INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_root TEXT NOT NULL UNIQUE,
+            fingerprint TEXT,
+            installed_at REAL NOT NULL
+        )
+    """
 
-    def append(self, template_root):
+    def __init__(self, connection):
+        self._connection = connection
+        self._connection.execute(self.SCHEMA)
+
+    def append(self, template_root, fingerprint=None):
         assert os.path.exists(template_root), template_root
         assert os.path.isdir(template_root), template_root
         template_root = os.path.abspath(template_root)
-        if template_root in self._template_roots:
-            LOG.debug(f"'{template_root}' is duplicate. Skipping.")
+        if template_root in self:
+            LOG.debug(f"'{template_root}' is already registered. Updating it.")
+        self._connection.execute(
+            "INSERT INTO roots (template_root, fingerprint, installed_at) "
+            "VALUES (?, ?, ?) ON CONFLICT (template_root) DO UPDATE SET "
+            "fingerprint = excluded.fingerprint, installed_at = excluded.installed_at",
+            (template_root, fingerprint, time.time()),
+        )
+
+    def add_all(self, template_roots):
+        for template_root in template_roots:
+            self.append(template_root)
+
+    def replace(self, old_root, new_root):
+        old_root = os.path.abspath(old_root)
+        if old_root not in self:
+            return self.append(new_root)
+        new_root = os.path.abspath(new_root)
+        if new_root in self:
+            self._connection.execute(
+                "DELETE FROM roots WHERE template_root = ?", (old_root,)
+            )
             return
-        self._template_roots.append(template_root)
+        self._connection.execute(
+            "UPDATE roots SET template_root = ?, installed_at = ? "
+            "WHERE template_root = ?",
+            (new_root, time.time(), old_root),
+        )
+
+    def __contains__(self, template_root):
+        cursor = self._connection.execute(
+            "SELECT 1 FROM roots WHERE template_root = ?", (template_root,)
+        )
+        return cursor.fetchone() is not None
+
+    def metadata(self, template_root):
+        cursor = self._connection.execute(
+            "SELECT fingerprint, installed_at FROM roots WHERE template_root = ?",
+            (os.path.abspath(template_root),),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(("fingerprint", "installed_at"), row))
 
     @property
     def template_roots(self):
-        return self._template_roots
+        cursor = self._connection.execute(
+            "SELECT template_root FROM roots ORDER BY position"
+        )
+        return [row[0] for row in cursor]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def close(self):
+        self._connection.close()
+
+    @classmethod
+    def _connect(cls, database):
+        return sqlite3.connect(database, timeout=60, isolation_level=None)
 
     @classmethod
     def from_list(cls, template_roots):
-        return cls(template_roots)
+        registry = cls(cls._connect(":memory:"))
+        registry.add_all(template_roots)
+        return registry
 
     @classmethod
-    def from_file(cls, registry_path):
-        if not os.path.exists(registry_path):
-            return cls([])
-        roots = open(registry_path, "r").readlines()
-        roots = (line.strip() for line in roots)
-        roots = (line for line in roots if len(line) > 0)
-        roots = list(roots)
-        return cls.from_list(roots)
-
-    def to_file(self, registry_path):
+    def from_file(cls, registry_path, create=False):
+        legacy_path = os.path.splitext(registry_path)[0] + cls.LEGACY_SUFFIX
+        exists = os.path.exists(registry_path) or os.path.exists(legacy_path)
+        if not exists and not create:
+            return cls.from_list([])
         dirname = os.path.dirname(registry_path)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        with open(registry_path, "w") as registry_file:
-            for template_root in self._template_roots:
-                registry_file.write(f"{template_root}\n")
+        connection = cls._connect(registry_path)
+        connection.execute("PRAGMA journal_mode = WAL")
+        registry = cls(connection)
+        if os.path.exists(legacy_path):
+            registry._import_legacy(legacy_path)
+        return registry
+
+    def _import_legacy(self, legacy_path):
+        with self.transaction():
+            if len(self.template_roots) == 0:
+                roots = open(legacy_path, "r").readlines()
+                roots = (line.strip() for line in roots)
+                roots = (line for line in roots if len(line) > 0)
+                for template_root in roots:
+                    self._connection.execute(
+                        "INSERT OR IGNORE INTO roots (template_root, installed_at) "
+                        "VALUES (?, ?)",
+                        (template_root, time.time()),
+                    )
+            try:
+                os.rename(legacy_path, f"{legacy_path}.migrated")
+            except FileNotFoundError:
+                pass
 
 
 class Base(contextlib.AbstractContextManager):
@@ -82,27 +309,37 @@ class Base(contextlib.AbstractContextManager):
     def __exit__(self, *args, **dargs):
         pass
 
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.__enter__)
+
+    async def __aexit__(self, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.__exit__, *args)
+
 
 class MinionFactory(Base):
     MINION_FACTORY = SaltMinion
 
     def __init__(self, config_obj):
         super().__init__(config_obj)
-        self._minion_svc = self.MINION_FACTORY.from_config(config_obj)
+        self._minion_sup = DaemonSupervisor.from_config(
+            self.MINION_FACTORY, config_obj
+        )
+        self._minion_svc = self._minion_sup.daemon
         self._block = hasattr(self._config_obj, "block") and getattr(
             self._config_obj, "block"
         )
 
     def __enter__(self, *args, **dargs):
-        self._minion_svc.start()
+        self._minion_sup.acquire()
         return super().__enter__(*args, **dargs)
 
     def __exit__(self, *args, **dargs):
         result = super().__exit__(*args, **dargs)
         if self._block:
             self._minion_svc.wait()
-        if self._minion_svc.running:
-            self._minion_svc.stop()
+        self._minion_sup.release()
         return result
 
 
@@ -112,46 +349,84 @@ class MasterFactory(Base):
 
     def __init__(self, config_obj, *args, **dargs):
         super().__init__(config_obj, *args, **dargs)
-        self._master_svc = self.MASTER_FACTORY.from_config(config_obj)
+        self._master_sup = DaemonSupervisor.from_config(
+            self.MASTER_FACTORY, config_obj
+        )
+        self._master_svc = self._master_sup.daemon
         self._block = hasattr(self._config_obj, "block") and getattr(
             self._config_obj, "block"
         )
 
     def __enter__(self, *args, **dargs):
-        self._master_svc.start()
+        try:
+            self._master_sup.acquire()
+        except RuntimeError:
+            # something outside saltbox took one of the allocated ports
+            allocator = PortAllocator(self._config_obj.saltbox_state_root)
+            if allocator.ports() == allocator.ports(recheck=True):
+                raise
+            LOG.warning(f"{self._master_svc.EXE} failed to bind. Using new ports.")
+            TemplateRenderer(self._config_obj).__enter__()
+            self._master_sup.acquire()
         return super().__enter__(*args, **dargs)
 
     def __exit__(self, *args, **dargs):
         result = super().__exit__(*args, **dargs)
         if self._block:
-            self._master_svc.   wait()
-        if self._master_svc.running:
-            self._master_svc.stop()
+            self._master_svc.wait()
+        self._master_sup.release()
         return result
 
 
 class RegistryWriter(Base):
     def __init__(self, config_obj):
-        self._registry = None
+        self._pending = None
+        self._jinja_env = None
         super().__init__(config_obj)
 
-    def add_package(self, package_dir):
-        assert self._registry is not None
-        self._registry.append(package_dir)
-
-    def _load(self):
-        self._registry = Registry.from_file(self._config_obj.saltbox_registry_path)
+    def _queue(self, method, *args, **dargs):
+        assert self._pending is not None
+        self._pending.append((method, args, dargs))
 
-    def _save(self):
-        self._registry.to_file(self._config_obj.saltbox_registry_path)
+    def add_package(self, package_dir):
+        index = self._compile(package_dir)
+        self._queue("append", package_dir, fingerprint=index.fingerprint)
+
+    def add_packages(self, package_dirs):
+        for package_dir in package_dirs:
+            self.add_package(package_dir)
+
+    def _compile(self, package_dir):
+        template_root = os.path.abspath(package_dir)
+        state_root = self._config_obj.saltbox_state_root
+        index = TemplateIndex.from_file(state_root, template_root).refresh()
+        if not index.dirty:
+            LOG.debug(f"'{template_root}' is already indexed and compiled")
+            return index
+        index.to_file(state_root)
+        if self._jinja_env is None:
+            self._jinja_env = RecipeTemplate.environment(
+                self._config_obj.saltbox_bytecode_cache_path
+            )
+        template = RecipeTemplate(template_root, self._jinja_env)
+        compiled = template.compile(sorted(index.templates))
+        LOG.debug(f"Precompiled {compiled} template(s) under '{template_root}'")
+        return index
 
     def __enter__(self, *args, **dargs):
-        self._load()
+        self._pending = []
         return super().__enter__(*args, **dargs)
 
     def __exit__(self, *args, **dargs):
-        self._save()
-        self._registry = None
+        # the registry is only locked for the writes themselves, not while
+        # packages are copied and compiled
+        pending, self._pending = self._pending, None
+        if args[0] is None and len(pending) > 0:
+            registry_path = self._config_obj.saltbox_registry_path
+            registry = Registry.from_file(registry_path, create=True)
+            with contextlib.closing(registry), registry.transaction():
+                for method, margs, mdargs in pending:
+                    getattr(registry, method)(*margs, **mdargs)
         return super().__exit__(*args, **dargs)
 
 
@@ -160,20 +435,29 @@ class Cache(Base):
         super().__init__(config_obj)
         if not os.path.exists(self._config_obj.saltbox_cache_root):
             os.makedirs(self._config_obj.saltbox_cache_root)
+        self._store = ContentStore(
+            self._config_obj.saltbox_cache_root,
+            max_bytes=self._config_obj.install_cache_max_bytes,
+        )
 
     def cache_dir(self, package_dir):
-        package_dir = os.path.abspath(package_dir)
-        hsh = hashlib.md5(package_dir.encode()).hexdigest()
-        cache_dir = os.path.join(
-            self._config_obj.saltbox_cache_root, hsh
-        )  # tempfile.mkdtemp(dir=self._config_obj.saltbox_cache_root)
-        return cache_dir
+        return self._store.tree_for(package_dir)
 
     def add_package(self, package_dir):
-        cache_dir = self.cache_dir(package_dir)
-        shutil.copytree(package_dir, cache_dir)
+        previous = self._store.tree_for(package_dir)
+        cache_dir = self._store.add_tree(package_dir)
+        if previous is not None and previous != cache_dir:
+            self._queue("replace", previous, cache_dir)
         super().add_package(cache_dir)
 
+    def __exit__(self, *args, **dargs):
+        result = super().__exit__(*args, **dargs)
+        registry_path = self._config_obj.saltbox_registry_path
+        with contextlib.closing(Registry.from_file(registry_path)) as registry:
+            template_roots = registry.template_roots
+        self._store.evict(keep=template_roots)
+        return result
+
 
 class BottomTemplate(Base):
     HERE = os.path.dirname(__file__)
@@ -192,34 +476,147 @@ class BottomTemplate(Base):
 
 class TemplateRenderer(Base):
     @classmethod
-    def render_all(cls, template_roots, salt_root):
-        template_vars = dict(SALTROOT=salt_root)
-        for template_root in template_roots:
-            cls.render_one(template_root, salt_root, template_vars)
+    def render_all(
+        cls,
+        template_roots,
+        salt_root,
+        state_root=None,
+        bytecode_cache_path=None,
+        workers=1,
+        parallel_threshold=None,
+        extra_vars=None,
+    ):
+        template_vars = dict(extra_vars or {}, SALTROOT=salt_root)
+        render_kwargs = dict(
+            bytecode_cache_path=bytecode_cache_path,
+            workers=workers,
+            parallel_threshold=parallel_threshold,
+        )
+        if state_root is None:
+            indexes = [TemplateIndex(root).refresh() for root in template_roots]
+            target = RenderManifest.from_indexes(indexes, template_vars)
+            changed = set(target.outputs)
+            cls._render_changed(
+                indexes, changed, salt_root, template_vars, **render_kwargs
+            )
+            return
+        indexes = [
+            TemplateIndex.from_file(state_root, template_root).refresh()
+            for template_root in template_roots
+        ]
+        target = RenderManifest.from_indexes(indexes, template_vars)
+        store = GenerationStore(state_root)
+        if cls._up_to_date(store, target, salt_root, indexes, state_root):
+            return
+        lock = store.lock()
+        with lock:
+            LOG.debug(f"Acquired lock {lock} rendering generation {target.generation}")
+            if cls._up_to_date(store, target, salt_root, indexes, state_root):
+                return
+            changed = store.current().changed(target, salt_root)
+            cls._render_changed(
+                indexes, changed, salt_root, template_vars, **render_kwargs
+            )
+            cls._save_indexes(indexes, state_root)
+            store.publish(target)
 
     @classmethod
-    def render_one(cls, template_root, salt_root, template_vars):
-        _t_vars = template_vars
-        with cls._cache_path() as tmp_dir:
-            LOG.debug(f"Rendering templates under '{template_root}' -> '{tmp_dir}'")
-            RecipeTemplate.render_to_path(template_root, tmp_dir, template_vars=_t_vars)
-            cls._merge(tmp_dir, salt_root)
+    def _up_to_date(cls, store, target, salt_root, indexes, state_root):
+        current = store.current()
+        if current.generation != target.generation or current.missing(salt_root):
+            return False
+        LOG.debug(f"Generation {target.generation} is current under '{salt_root}'")
+        cls._save_indexes(indexes, state_root)
+        return True
+
+    @staticmethod
+    def _save_indexes(indexes, state_root):
+        for index in indexes:
+            if index.dirty:
+                index.to_file(state_root)
 
     @classmethod
-    def _merge(cls, tmp_dir, dst_root):
-        assert RSYNC is not None, "Salt box depends on rsync, please install via your system's package manager"
-        lock = FileLock(os.path.join(dst_root, 'lock'))
-        with lock:
-            LOG.debug(f'Acquired lock {lock} running rsync')
-            run(shlex.split(f"{RSYNC} -a --inplace {tmp_dir}/ {dst_root}"))
+    def _render_changed(
+        cls, indexes, changed, salt_root, template_vars, **render_kwargs
+    ):
+        LOG.debug(f"{len(changed)} rendered file(s) out of date under '{salt_root}'")
+        for index in indexes:
+            for rel_dir in index.dirs:
+                os.makedirs(os.path.join(salt_root, rel_dir), exist_ok=True)
+        cls.render_indexes(indexes, changed, salt_root, template_vars, **render_kwargs)
+
+    @classmethod
+    def render_indexes(
+        cls, indexes, relpaths, salt_root, template_vars, **render_kwargs
+    ):
+        overlay = TemplateIndex.overlay(indexes)
+        jobs = []
+        for relpath in sorted(relpaths.intersection(overlay)):
+            index = overlay[relpath]
+            entry = index.files[relpath]
+            jobs.append((index.root_dir, relpath, entry["template"], entry["mode"]))
+        cls._render_jobs(jobs, salt_root, template_vars, **render_kwargs)
 
     @classmethod
-    def _cache_path(cls):
-        return tempfile.TemporaryDirectory()
+    def render_one(
+        cls, template_root, salt_root, template_vars, relpaths=None, **render_kwargs
+    ):
+        index = TemplateIndex(template_root).refresh()
+        relpaths = set(index.files if relpaths is None else relpaths)
+        cls.render_indexes([index], relpaths, salt_root, template_vars, **render_kwargs)
+
+    @classmethod
+    def _render_jobs(cls, jobs, salt_root, template_vars, **render_kwargs):
+        if len(jobs) == 0:
+            return
+        templates = [(root, relpath) for root, relpath, template, _ in jobs if template]
+        LOG.debug(
+            f"Rendering {len(templates)} template(s), "
+            f"linking {len(jobs) - len(templates)} file(s) -> '{salt_root}'"
+        )
+        rendered = RecipeTemplate.render_many(templates, template_vars, **render_kwargs)
+        written = collections.Counter()
+        with contextlib.closing(rendered):
+            for template_root, relpath, template, mode in jobs:
+                src_path = os.path.join(template_root, relpath)
+                dst_path = os.path.join(salt_root, relpath)
+                if not template:
+                    strategy = RecipeTemplate.link_file(src_path, dst_path, mode)
+                    if strategy is not None:
+                        written[strategy] += 1
+                    continue
+                contents = next(rendered)
+                written["render"] += RecipeTemplate.merge_file(contents, dst_path, mode)
+        LOG.debug(
+            f"Merged {sum(written.values())} of {len(jobs)} file(s) "
+            f"into '{salt_root}': {dict(+written)}"
+        )
+
+    def _uses_daemons(self):
+        return any(
+            hasattr(self._config_obj, name) and getattr(self._config_obj, name)
+            for name in ("master", "minion")
+        )
 
     def __enter__(self, *args, **dargs):
-        registry = Registry.from_file(self._config_obj.saltbox_registry_path)
-        self.render_all(registry.template_roots, self._config_obj.salt_root_path)
+        registry_path = self._config_obj.saltbox_registry_path
+        with contextlib.closing(Registry.from_file(registry_path)) as registry:
+            template_roots = registry.template_roots
+        allocator = PortAllocator(self._config_obj.saltbox_state_root)
+        if self._uses_daemons():
+            ports = allocator.ports()
+        else:
+            # keep rendering with the last ports so the vars don't flip
+            ports = allocator.allocated()
+        self.render_all(
+            template_roots,
+            self._config_obj.salt_root_path,
+            self._config_obj.saltbox_state_root,
+            self._config_obj.saltbox_bytecode_cache_path,
+            self._config_obj.render_workers,
+            self._config_obj.render_parallel_threshold,
+            ports,
+        )
         return super().__enter__(*args, **dargs)
 
     # def __exit__(self, *args, **dargs):
@@ -244,10 +641,121 @@ class Executor(Base):
         return call(args)
 
     def run(self, *args, **dargs):
-        capture_output = dargs.pop('capture_output', False)
+        capture_output = dargs.pop('capture_output', True)
         args = self._format_args(args)
         return run(args, capture_output)
 
+    def stream(self, *args, **dargs):
+        args = self._format_args(args)
+        return stream(args, **dargs)
+
+    def apply_batch(self, runner, targets, pillar, saltenv):
+        proc = self.run(*runner,
+                        "--out=json",
+                        ",".join(targets),
+                        f"pillar={json.dumps(pillar)}",
+                        f"saltenv={saltenv}")
+        sys.stderr.buffer.write(proc.stderr)
+        try:
+            ret = json.loads(proc.stdout)
+        except ValueError:
+            LOG.error(f"Batch {targets} returned no JSON (exit {proc.returncode})")
+            return {target: (proc.returncode or 1, None) for target in targets}
+        if isinstance(ret, dict) and list(ret) == ["local"]:
+            ret = ret["local"]
+        return self._split_batch(ret, targets, proc.returncode)
+
+    @staticmethod
+    def _split_batch(ret, targets, returncode):
+        if not isinstance(ret, dict) or not all(
+                isinstance(state, dict) and "__sls__" in state
+                for state in ret.values()):
+            return {target: (returncode, ret) for target in targets}
+        states = {target: {} for target in targets}
+        for state_id, state in ret.items():
+            owners = [state["__sls__"]] if state["__sls__"] in states else targets
+            for owner in owners:
+                states[owner][state_id] = state
+        return {
+            target: (int(any(state.get("result") is False
+                             for state in target_states.values())), target_states)
+            for target, target_states in states.items()
+        }
+
+    async def execute_async(self, *args, **dargs):
+        args = self._format_args(args)
+        return await call_async(args, **dargs)
+
+    async def run_async(self, *args, **dargs):
+        capture_output = dargs.pop('capture_output', True)
+        args = self._format_args(args)
+        return await run_async(args, capture_output, **dargs)
+
+
+class InProcessExecutor(Executor):
+    CALL_EXE = "salt-call"
+    LOCAL_FLAG = "--local"
+
+    def __init__(self, config_obj):
+        super().__init__(config_obj)
+        self._callers = {}
+
+    def caller(self, local=False):
+        if local not in self._callers:
+            self._callers[local] = self._config_obj.call_client(local=local)
+        return self._callers[local]
+
+    def call(self, fun, *args, **kwargs):
+        local = kwargs.pop("local", False)
+        LOG.debug(f"Calling {fun} in process")
+        return self.caller(local).cmd(fun, *args, **kwargs)
+
+    def _parse_call(self, args):
+        arg_list = list(args)
+        if os.path.basename(arg_list.pop(0)) != self.CALL_EXE:
+            return None
+        local = self.LOCAL_FLAG in arg_list
+        arg_list = [_a for _a in arg_list if _a != self.LOCAL_FLAG]
+        if not arg_list or any(_a.startswith("-") for _a in arg_list):
+            return None
+        import salt.utils.args
+
+        fun = arg_list.pop(0)
+        fun_args, fun_kwargs = salt.utils.args.parse_input(arg_list, condition=False)
+        return fun, fun_args, dict(fun_kwargs, local=local)
+
+    def execute(self, *args, **dargs):
+        parsed = self._parse_call(args)
+        if parsed is None:
+            LOG.debug(f"Cannot run {args} in process. Falling back to a subprocess.")
+            return super().execute(*args, **dargs)
+        fun, fun_args, fun_kwargs = parsed
+        try:
+            ret = self.call(fun, *fun_args, **fun_kwargs)
+        except Exception:
+            LOG.exception(f"{fun} failed")
+            return 1
+        if fun.startswith("state."):
+            import salt.utils.state
+
+            return int(not salt.utils.state.check_result(ret))
+        return 0
+
+
+class PooledExecutor(Executor):
+    def __init__(self, config_obj):
+        super().__init__(config_obj)
+        self._worker = WorkerClient.from_config(config_obj)
+
+    def execute(self, *args, **dargs):
+        args = self._format_args(args)
+        if not WorkerClient.supports(args):
+            return call(args)
+        retcode = self._worker.execute(args)
+        if retcode is None:
+            return call(args)
+        return retcode
+
 
 class SaltBox:
     @staticmethod
@@ -262,7 +770,12 @@ class SaltBox:
 
     @staticmethod
     def executor_factory(config_obj):
-        bases = [Executor, TemplateRenderer]
+        executor = Executor
+        if config_obj.in_process:
+            executor = InProcessExecutor
+        elif config_obj.worker_pool:
+            executor = PooledExecutor
+        bases = [executor, TemplateRenderer]
         if hasattr(config_obj, "master") and config_obj.master:
             bases.append(MasterFactory)
         if hasattr(config_obj, "minion") and config_obj.minion:
@@ -282,8 +795,9 @@ class SaltBox:
 
 
 class SaltBoxConfig(types.SimpleNamespace):
-    BOX_DEFAULT_REGISTRY_PATH = "etc/saltbox/registry.txt"
+    BOX_DEFAULT_REGISTRY_PATH = "etc/saltbox/registry.db"
     BOX_DEFAULT_CACHE_PATH = "var/cache/saltbox"
+    BOX_DEFAULT_STATE_PATH = "var/lib/saltbox"
     SALT_DEFAULT_CONFIG_PATH = "etc/salt"
     SALT_DEFAULT_RUN_PATH = "var/run"
 
@@ -293,10 +807,87 @@ class SaltBoxConfig(types.SimpleNamespace):
             if hasattr(self, "_use_install_cache") \
                else False
 
+    @property
+    def render_workers(self):
+        return self._render_workers \
+            if hasattr(self, "_render_workers") and \
+               self._render_workers is not None \
+               else 1
+
+    @property
+    def render_parallel_threshold(self):
+        return self._render_parallel_threshold \
+            if hasattr(self, "_render_parallel_threshold") \
+               else None
+
+    @property
+    def install_cache_max_bytes(self):
+        return self._install_cache_max_bytes \
+            if hasattr(self, "_install_cache_max_bytes") \
+               else None
+
+    @property
+    def daemon_start_timeout(self):
+        return self._daemon_start_timeout \
+            if hasattr(self, "_daemon_start_timeout") \
+               else None
+
+    @property
+    def daemon_idle_timeout(self):
+        return self._daemon_idle_timeout \
+            if hasattr(self, "_daemon_idle_timeout") \
+               else None
+
+    @property
+    def daemon_stop_timeout(self):
+        return self._daemon_stop_timeout \
+            if hasattr(self, "_daemon_stop_timeout") \
+               else None
+
+    @property
+    def in_process(self):
+        return self._in_process \
+            if hasattr(self, "_in_process") \
+               else False
+
+    @property
+    def worker_pool(self):
+        return self._worker_pool \
+            if hasattr(self, "_worker_pool") \
+               else False
+
+    @property
+    def worker_idle_timeout(self):
+        return self._worker_idle_timeout \
+            if hasattr(self, "_worker_idle_timeout") \
+               else None
+
+    @property
+    def salt_config(self):
+        if not hasattr(self, "_salt_config"):
+            self._salt_config = SaltConfig(self.salt_root_path)
+        return self._salt_config
+
+    @property
+    def minion_opts(self):
+        return self.salt_config.minion_opts
+
+    @property
+    def master_opts(self):
+        return self.salt_config.master_opts
+
     @property
     def saltbox_cache_root(self):
         return os.path.join(self._prefix, self.BOX_DEFAULT_CACHE_PATH)
 
+    @property
+    def saltbox_bytecode_cache_path(self):
+        return os.path.join(self.saltbox_cache_root, "jinja")
+
+    @property
+    def saltbox_state_root(self):
+        return os.path.join(self._prefix, self.BOX_DEFAULT_STATE_PATH)
+
     @property
     def salt_root_path(self):
         return self._prefix
@@ -333,12 +924,13 @@ class SaltBoxConfig(types.SimpleNamespace):
         _dargs = {f"_{k}": v for k, v in dargs.items()}
         return cls(**_dargs)
 
-    def call_client(self):
+    def call_client(self, local=False):
+        import salt.client
+
         mopts = self.minion_opts
+        if local:
+            mopts["file_client"] = "local"
         return salt.client.Caller(mopts=mopts)
 
     def cloud_client(self):
-        cfg_path = os.path.join(self.config_dir, "cloud")
-        assert os.path.exists(cfg_path)
-        opts = salt.config.cloud_config(path=cfg_path)
-        return salt.cloud.CloudClient(opts=opts)
+        return self.salt_config.cloud_client()
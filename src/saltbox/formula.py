@@ -1,3 +1,5 @@
+import collections.abc
+import hashlib
 import logging
 import plugnparse
 import yaml
@@ -7,15 +9,72 @@ import argparse
 import json
 import shlex
 import sys
-import jinja2
 import types
 import site
 
+from . import utils
 from .api import SaltBox, SaltBoxConfig
+from .sandbox import SandboxPool
+from .template import TemplateIndex
 
 cli_entrypoint = plugnparse.entrypoint
 LOG = logging.getLogger(__name__)
 
+class CompiledFormula:
+    _CACHE = {}
+
+    def __init__(self, blob):
+        self._blob = blob
+        self._parser = None
+        self._template = None
+
+    @classmethod
+    def from_blob(cls, blob):
+        # YAML can produce values json cannot encode (dates, ...)
+        key = hashlib.sha1(
+            json.dumps(blob, sort_keys=True, default=repr).encode()
+        ).hexdigest()
+        if key not in cls._CACHE:
+            cls._CACHE[key] = cls(blob)
+        return cls._CACHE[key]
+
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = self._build_parser(self._blob["args"])
+        return self._parser
+
+    @property
+    def template(self):
+        if self._template is None:
+            import jinja2
+
+            self._template = jinja2.Template(self._blob["template"])
+        return self._template
+
+    @property
+    def saltargs(self):
+        return " ".join(f"{k}={v}" for k, v in self._blob.get("saltargs", {}).items())
+
+    @staticmethod
+    def _build_parser(arg_blobs):
+        parser = argparse.ArgumentParser()
+        for blob in arg_blobs:
+            kwargs = blob.copy()
+            args = kwargs.pop("name", [])
+            if not isinstance(args, list):
+                args = [args]
+            if "type" in kwargs:
+                kwargs["type"] = eval(kwargs["type"])
+            if "const" in kwargs:
+                kwargs["const"] = eval(kwargs["const"])
+            parser.add_argument(*args, **kwargs)
+        return parser
+
+    def format_cmd(self, **fields):
+        _cmd = shlex.split(self._blob["cmd"].format(**fields))
+        return [_c for _c in _cmd if _c != '\n']
+
 class Formula:
 
     def __init__(self, blob):
@@ -61,6 +120,10 @@ class Formula:
     def _runner(self):
         return shlex.split(self.runner)
 
+    @property
+    def compiled(self):
+        return CompiledFormula.from_blob(self._blob)
+
     @property
     def descr(self):
         return self._blob.get("descr", "")
@@ -76,9 +139,11 @@ class Formula:
         if self.template:
             return self._run_template(api, *run_args)
 
+    def _runner_pillar(self, *run_args):
+        return vars(self.parser.parse_args(run_args))
+
     def _run_runner(self, api, *run_args):
-        ns = self.parser.parse_args(run_args)
-        pillar = json.dumps(vars(ns))
+        pillar = json.dumps(self._runner_pillar(*run_args))
         saltenv = self.saltenv
         return api.execute(*self._runner,
                            self.name,
@@ -86,16 +151,15 @@ class Formula:
                            f"saltenv={saltenv}")
 
     def _run_cmd(self, api, *run_args):
-        ns = self.parser.parse_args(run_args)
-        ns.saltargs = " ".join(f"{k}={v}" for k, v in self.saltargs.items()).format(**vars(ns))
-        cmd_str = self.cmd.format(**vars(ns))
-        _cmd = shlex.split(cmd_str)
-        _cmd = [_c for _c in _cmd if _c != '\n']
-        return api.execute(*_cmd)
+        compiled = self.compiled
+        ns = compiled.parser.parse_args(run_args)
+        ns.saltargs = compiled.saltargs.format(**vars(ns))
+        return api.execute(*compiled.format_cmd(**vars(ns)))
 
     def _run_template(self, api, *run_args):
-        ns = self.parser.parse_args(run_args)
-        template = jinja2.Template(self.template)
+        compiled = self.compiled
+        ns = compiled.parser.parse_args(run_args)
+        template = compiled.template
         _saltbox = types.SimpleNamespace(formula=self, api=api, cli=vars(ns))
         cmd_str = template.render(saltbox=_saltbox)
         _cmd = shlex.split(cmd_str)
@@ -104,34 +168,111 @@ class Formula:
 
     @property
     def parser(self):
-        parser = argparse.ArgumentParser()
-        for blob in self._blob["args"]:
-            kwargs = blob.copy()
-            args = kwargs.pop("name", [])
-            if not isinstance(args, list):
-                args = [args]
-            if "type" in kwargs:
-                kwargs["type"] = eval(kwargs["type"])
-            if "const" in kwargs:
-                kwargs["const"] = eval(kwargs["const"])
-            parser.add_argument(*args, **kwargs)
-        return parser
+        return self.compiled.parser
+
+class FormulaBatch:
+
+    def __init__(self, runner, saltenv):
+        self._runner = runner
+        self._saltenv = saltenv
+        self._targets = []
+        self._pillar = {}
+        self._indexes = {}
+
+    def accepts(self, formula, pillar):
+        if (formula._runner, formula.saltenv) != (self._runner, self._saltenv):
+            return False
+        if formula.name in self._indexes:
+            return False
+        return all(self._pillar.get(k, v) == v for k, v in pillar.items())
+
+    def add(self, index, formula, pillar):
+        self._targets.append(formula.name)
+        self._pillar.update(pillar)
+        self._indexes[formula.name] = index
+
+    def apply(self, api):
+        LOG.debug(f"Applying {self._targets} in one run")
+        ret = api.apply_batch(self._runner, self._targets, self._pillar, self._saltenv)
+        return {self._indexes[target]: ret[target] for target in self._targets}
+
+def run_batch(api, invocations):
+    # only consecutive runner invocations are merged, so side effects keep
+    # the order of the input list
+    results = [None] * len(invocations)
+    batch = None
+    for index, (formula, run_args) in enumerate(invocations):
+        if not formula.runner:
+            if batch is not None:
+                _apply_batch(api, batch, results)
+                batch = None
+            results[index] = (formula.run(api, *run_args), None)
+            continue
+        pillar = formula._runner_pillar(*run_args)
+        if batch is not None and not batch.accepts(formula, pillar):
+            _apply_batch(api, batch, results)
+            batch = None
+        if batch is None:
+            batch = FormulaBatch(formula._runner, formula.saltenv)
+        batch.add(index, formula, pillar)
+    if batch is not None:
+        _apply_batch(api, batch, results)
+    return results
+
+def _apply_batch(api, batch, results):
+    for index, ret in batch.apply(api).items():
+        results[index] = ret
+
+class FormulaMap(collections.abc.Mapping):
+
+    def __init__(self, blobs):
+        self._blobs = {blob["name"]: blob for blob in blobs}
+        self._formulas = {}
+
+    def __getitem__(self, name):
+        if name not in self._formulas:
+            self._formulas[name] = Formula.from_blob(self._blobs[name])
+        return self._formulas[name]
+
+    def __contains__(self, name):
+        return name in self._blobs
+
+    def __iter__(self):
+        return iter(self._blobs)
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({list(self._blobs)})"
 
 class Manifest:
+    _CACHE = {}
+
     def __init__(self, blob):
         self._blob = blob or {}
+        self._formulas = None
 
     @classmethod
     def from_path(cls, path):
         assert os.path.exists(path), path
         assert os.path.isfile(path), path
-        with open(path) as manifest_file:
-            return cls(yaml.load(manifest_file))
+        path = os.path.abspath(path)
+        path_stat = os.stat(path)
+        key = (cls, path)
+        stamp = (path_stat.st_mtime_ns, path_stat.st_size)
+        cached = cls._CACHE.get(key)
+        if cached is None or cached[0] != stamp:
+            with open(path) as manifest_file:
+                manifest = cls(yaml.load(manifest_file, Loader=utils.SafeLoader))
+            cached = cls._CACHE[key] = (stamp, manifest)
+        return cached[1]
 
     @property
     def formulas(self):
-        return {Formula.from_blob(entry).name: Formula.from_blob(entry) for
-                entry in self._blob.get("formulas", [])}
+        if self._formulas is None:
+            self._formulas = FormulaMap(self._blob.get("formulas", []))
+        return self._formulas
 
     @property
     def name(self):
@@ -157,6 +298,10 @@ class Box:
         manifest_path = os.path.join(self._path, self._MANIFEST_FILENAME)
         return self._MANIFEST_CLASS.from_path(manifest_path)
 
+    @property
+    def template_index(self):
+        return TemplateIndex(os.path.abspath(self._path)).refresh()
+
     @classmethod
     def from_path(cls, path):
         box = cls(path)
@@ -175,15 +320,21 @@ def logging_config(log_level):
         logging.basicConfig(level=log_level.upper())
 
 def ___exec___args(parser):
+    parser.add_argument("--fresh", default=False, action="store_true")
     parser.add_argument("path")
     parser.add_argument("formula")
     parser.add_argument("exec_args", nargs=argparse.REMAINDER)
 
 @cli_entrypoint(["_", "exec"], args=___exec___args)
-def ___exec__(parser, log_level, path, formula, exec_args):
+def ___exec__(parser, log_level, path, formula, exec_args, fresh=False):
     logging_config(log_level)
     box = Box.from_path(path)
     assert formula in box.manifest.formulas, box.manifest.formulas
+    if not fresh:
+        formula = box.manifest.formulas[formula]
+        with SandboxPool.from_env().sandbox(box, formula) as config:
+            with SaltBox.executor_factory(config) as api:
+                return formula.run(api, *exec_args)
     retcode = 1
     with tempfile.TemporaryDirectory() as tmp_dir:
         formula = box.manifest.formulas[formula]
@@ -196,3 +347,32 @@ def ___exec__(parser, log_level, path, formula, exec_args):
             api.add_package(path)
         with SaltBox.executor_factory(config) as api:
             return formula.run(api, *exec_args)
+
+def ___warm___args(parser):
+    parser.add_argument("-s", "--slots", default=1, type=int)
+    parser.add_argument("path")
+    parser.add_argument("formulas", nargs="*")
+
+@cli_entrypoint(["_", "warm"], args=___warm___args)
+def ___warm__(parser, log_level, path, formulas, slots=1):
+    logging_config(log_level)
+    box = Box.from_path(path)
+    pool = SandboxPool.from_env()
+    for name in formulas or box.manifest.formulas:
+        assert name in box.manifest.formulas, box.manifest.formulas
+        pool.warm(box, box.manifest.formulas[name], slots=slots)
+
+def ___deps___args(parser):
+    parser.add_argument("path")
+    parser.add_argument("template", nargs="?", default=None)
+
+@cli_entrypoint(["_", "deps"], args=___deps___args)
+def ___deps__(parser, log_level, path, template):
+    logging_config(log_level)
+    index = Box.from_path(path).template_index
+    if template is not None:
+        for dependent in sorted(index.dependents(template)):
+            print(dependent)
+        return
+    for relpath, deps in index.graph.items():
+        print(f"{relpath}: {' '.join(str(d) for d in deps)}")
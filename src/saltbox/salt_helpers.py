@@ -1,9 +1,20 @@
+import copy
+import glob
+import hashlib
 import logging
 import os
+import select
+import signal
+import socket
 import subprocess
+import sys
+import threading
 import time
+import types
 
-import salt
+from filelock import FileLock
+
+from . import utils
 
 LOG = logging.getLogger(__name__)
 
@@ -46,12 +57,70 @@ LOG = logging.getLogger(__name__)
 # daemons
 
 
+class PidWaiter:
+    def __init__(self, pid):
+        self._pid = pid
+        self._pidfd = None
+        self._exited = False
+        if hasattr(os, "pidfd_open"):
+            try:
+                self._pidfd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                self._exited = True
+            except OSError:
+                self._pidfd = None
+
+    def _alive(self):
+        try:
+            os.kill(self._pid, SaltDaemon.STATUS_SIGNAL)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def wait(self, timeout=None):
+        if self._exited:
+            return True
+        if self._pidfd is not None:
+            poller = select.poll()
+            poller.register(self._pidfd, select.POLLIN)
+            timeout_ms = None if timeout is None else timeout * 1000
+            self._exited = len(poller.poll(timeout_ms)) > 0
+            return self._exited
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.005
+        while self._alive():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            remaining = 0.1 if deadline is None else deadline - time.monotonic()
+            time.sleep(max(0, min(delay, remaining)))
+            delay = min(delay * 2, 0.1)
+        self._exited = True
+        return True
+
+    def close(self):
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class SaltDaemon:
     SIGHUP_SIGNAL = 9
     STATUS_SIGNAL = 0
     CFG_FILENAME = None
     EXE = None
     PIDFILE = None
+    SOCK_DIR = None
+    READY_SOCKETS = ()
+    START_TIMEOUT = 30
+    STOP_TIMEOUT = 10
 
     def __init__(self, config_obj):
         # assert self.CFG_FILENAME is not None
@@ -59,6 +128,10 @@ class SaltDaemon:
         self._config_obj = config_obj
         self._running = False
 
+    def _timeout(self, name, default):
+        timeout = getattr(self._config_obj, name, None)
+        return default if timeout is None else timeout
+
     def start(self, daemon=True):
         if self.running:
             return
@@ -67,37 +140,123 @@ class SaltDaemon:
         args = [self.EXE, "--config-dir", _cfg, "--log-level", "debug"]
         if daemon:
             args.append("--daemon")
+        self._clear_stale()
         ret_code = subprocess.call(args)
         assert ret_code == 0, ret_code
         self._running = True
+        if daemon:
+            self._wait_ready(self._timeout("daemon_start_timeout", self.START_TIMEOUT))
+
+    def _wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        waiter = None
+        try:
+            while not self.ready:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"{self.EXE} not ready after {timeout}s")
+                pid = self.pid
+                if waiter is None and pid is not None:
+                    waiter = PidWaiter(pid)
+                if waiter is None:
+                    time.sleep(min(delay, remaining))
+                elif waiter.wait(min(delay, remaining)):
+                    self._running = False
+                    raise RuntimeError(f"{self.EXE} (pid {pid}) exited on startup")
+                delay = min(delay * 2, 0.1)
+        finally:
+            if waiter is not None:
+                waiter.close()
+        LOG.debug(f"{self.EXE} (pid {self.pid}) is ready")
+
+    def _clear_stale(self):
+        # a killed (or even cleanly stopped) daemon leaves its pidfile and IPC
+        # socket files behind; they would make a restart look ready early
+        if self.alive:
+            return
+        sock_dir = os.path.join(self._config_obj.salt_run_path, self.SOCK_DIR or "")
+        stale = [os.path.join(self._config_obj.salt_run_path, self.PIDFILE)]
+        for pattern in self.READY_SOCKETS:
+            stale.extend(glob.glob(os.path.join(sock_dir, pattern)))
+        for path in stale:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def ready(self):
+        if self.pid is None:
+            return False
+        sock_dir = os.path.join(self._config_obj.salt_run_path, self.SOCK_DIR or "")
+        return all(
+            len(glob.glob(os.path.join(sock_dir, pattern))) > 0
+            for pattern in self.READY_SOCKETS
+        )
 
     def stop(self):
         if not self.running:
             return
         pid = self.pid
         if pid is not None:
-            subprocess.run(['killall', '-9', 'salt-master'])
+            self._terminate(pid)
         self._running = False
 
-    def wait(self):
+    def _signal(self, pid, signum):
+        # daemonized salt leads its own process group, which holds its workers
+        try:
+            if os.getpgid(pid) == pid:
+                os.killpg(pid, signum)
+            else:
+                os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _terminate(self, pid):
+        timeout = self._timeout("daemon_stop_timeout", self.STOP_TIMEOUT)
+        with PidWaiter(pid) as waiter:
+            self._signal(pid, signal.SIGTERM)
+            if waiter.wait(timeout):
+                return
+            LOG.warning(f"{self.EXE} (pid {pid}) ignored SIGTERM, killing it")
+            self._signal(pid, signal.SIGKILL)
+            waiter.wait(timeout)
+
+    def wait(self, timeout=None):
         if not self.running:
             return
         pid = self.pid
         assert pid is not None
-        while not os.kill(pid, self.STATUS_SIGNAL):
-            time.sleep(1)
+        with PidWaiter(pid) as waiter:
+            if not waiter.wait(timeout):
+                raise TimeoutError(f"{self.EXE} (pid {pid}) still running")
         self._running = False
 
     @property
     def running(self):
         return self._running
 
+    @property
+    def alive(self):
+        pid = self.pid
+        if pid is None:
+            return False
+        with PidWaiter(pid) as waiter:
+            return not waiter.wait(0)
+
+    def attach(self):
+        self._running = self.alive
+        return self._running
+
     @property
     def pid(self):
         pid_file_path = os.path.join(self._config_obj.salt_run_path, self.PIDFILE)
-        if not os.path.exists(pid_file_path):
+        try:
+            return int(open(pid_file_path).read())
+        except (FileNotFoundError, ValueError):
+            # missing, or not fully written yet
             return None
-        return int(open(pid_file_path).read())
 
     # def __enter__(self):
     #     return self
@@ -113,19 +272,266 @@ class SaltDaemon:
         return daemon
 
 
+class DaemonSupervisor:
+    def __init__(self, daemon, idle_timeout=None):
+        self._daemon = daemon
+        self._idle_timeout = idle_timeout or 0
+
+    @property
+    def daemon(self):
+        return self._daemon
+
+    @property
+    def _run_path(self):
+        return self._daemon._config_obj.salt_run_path
+
+    @property
+    def _state_path(self):
+        return os.path.join(self._run_path, f"{self._daemon.EXE}.holders.json")
+
+    def _lock(self):
+        os.makedirs(self._run_path, exist_ok=True)
+        return FileLock(os.path.join(self._run_path, f"{self._daemon.EXE}.lock"))
+
+    def _load(self):
+        state = utils.load_json(self._state_path, default={})
+        holders = [pid for pid in state.get("holders", []) if self._holder_alive(pid)]
+        return holders, state.get("released_at")
+
+    def _save(self, holders, released_at=None):
+        state = dict(holders=holders, released_at=released_at)
+        utils.dump_json(state, self._state_path)
+
+    @staticmethod
+    def _holder_alive(pid):
+        with PidWaiter(pid) as waiter:
+            return not waiter.wait(0)
+
+    def acquire(self):
+        with self._lock():
+            holders, _ = self._load()
+            if self._daemon.attach():
+                LOG.debug(
+                    f"Attached to running {self._daemon.EXE} "
+                    f"({len(holders)} other holder(s))"
+                )
+            else:
+                self._daemon.start()
+            holders.append(os.getpid())
+            self._save(holders)
+        return self._daemon
+
+    def release(self):
+        with self._lock():
+            holders, _ = self._load()
+            if os.getpid() in holders:
+                holders.remove(os.getpid())
+            if len(holders) > 0:
+                self._save(holders)
+                return
+            if self._idle_timeout <= 0:
+                self._save(holders)
+                self._stop()
+                return
+            released_at = time.time()
+            self._save(holders, released_at)
+        self._spawn_reaper(released_at)
+
+    def _stop(self):
+        if self._daemon.attach():
+            self._daemon.stop()
+
+    def _spawn_reaper(self, released_at):
+        config_obj = self._daemon._config_obj
+        args = [
+            sys.executable, "-m", __name__, "reap", self._daemon.EXE,
+            config_obj.salt_config_path, config_obj.salt_run_path,
+            str(self._idle_timeout), repr(released_at),
+        ]
+        LOG.debug(f"Keeping {self._daemon.EXE} warm for {self._idle_timeout}s")
+        subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def reap(self, released_at):
+        time.sleep(self._idle_timeout)
+        with self._lock():
+            holders, last_release = self._load()
+            if len(holders) > 0 or last_release != released_at:
+                return False
+            self._save(holders)
+            self._stop()
+        return True
+
+    @classmethod
+    def from_config(cls, daemon_cls, config_obj):
+        idle_timeout = getattr(config_obj, "daemon_idle_timeout", None)
+        return cls(daemon_cls.from_config(config_obj), idle_timeout)
+
+
+class PortAllocator:
+    PORTS = ("PUBLISH_PORT", "RET_PORT")
+    HOST_ENV = "SALTBOX_PORTS_PATH"
+    EPHEMERAL_RANGE_PATH = "/proc/sys/net/ipv4/ip_local_port_range"
+    EPHEMERAL_RANGE = (32768, 60999)
+    PORT_RANGE = (10000, 65535)
+
+    def __init__(self, state_root, host_path=None):
+        self._state_root = os.path.abspath(state_root)
+        self._host_path = host_path or os.environ.get(self.HOST_ENV)
+
+    @property
+    def _host_ports_path(self):
+        if self._host_path is None:
+            self._host_path = os.path.join(
+                utils.private_dir(utils.runtime_dir()), "saltbox-ports.json"
+            )
+        return self._host_path
+
+    @property
+    def _ports_path(self):
+        return os.path.join(self._state_root, "ports.json")
+
+    @classmethod
+    def port_range(cls):
+        # ports the kernel hands out for outgoing connections and bind(0) are
+        # never allocated, so nothing but another box can take ours
+        try:
+            with open(cls.EPHEMERAL_RANGE_PATH) as range_file:
+                ephemeral_low, ephemeral_high = map(int, range_file.read().split())
+        except (OSError, ValueError):
+            ephemeral_low, ephemeral_high = cls.EPHEMERAL_RANGE
+        low, high = cls.PORT_RANGE
+        below = range(low, max(low, min(ephemeral_low, high + 1)))
+        above = range(min(high + 1, max(ephemeral_high + 1, low)), high + 1)
+        return max(below, above, key=len)
+
+    @staticmethod
+    def bindable(port):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(("", port))
+            except OSError:
+                return False
+            return True
+
+    def _load_host(self):
+        # drop ports whose box was deleted or has since moved to other ports
+        host = utils.load_json(self._host_ports_path, default={})
+        owned = {}
+        for state_root in set(host.values()):
+            ports = utils.load_json(os.path.join(state_root, "ports.json"), default={})
+            owned[state_root] = set(ports.values())
+        return {
+            port: state_root
+            for port, state_root in host.items()
+            if int(port) in owned[state_root]
+        }
+
+    def _free_port(self, host):
+        port_range = self.port_range()
+        digest = hashlib.sha1(self._state_root.encode()).digest()
+        start = int.from_bytes(digest[:4], "big") % len(port_range)
+        for offset in range(len(port_range)):
+            port = port_range[(start + offset) % len(port_range)]
+            if str(port) not in host and self.bindable(port):
+                return port
+        raise RuntimeError(f"No free port left in {port_range}")
+
+    def allocated(self):
+        return utils.load_json(self._ports_path, default={})
+
+    def ports(self, recheck=False):
+        port_range = self.port_range()
+        ports = utils.load_json(self._ports_path, default={})
+        if not recheck and all(
+            ports.get(name, -1) in port_range for name in self.PORTS
+        ):
+            return ports
+        os.makedirs(self._state_root, exist_ok=True)
+        with FileLock(os.path.join(self._state_root, "ports.lock")), FileLock(
+            f"{self._host_ports_path}.lock"
+        ):
+            host = self._load_host()
+            ports = utils.load_json(self._ports_path, default={})
+            for name in self.PORTS:
+                port = ports.get(name, -1)
+                if (
+                    port in port_range
+                    and host.get(str(port)) == self._state_root
+                    and not (recheck and not self.bindable(port))
+                ):
+                    continue
+                if port != -1:
+                    LOG.debug(f"Reallocating {name} (was {port})")
+                if host.get(str(port)) == self._state_root:
+                    del host[str(port)]
+                ports[name] = self._free_port(host)
+                host[str(ports[name])] = self._state_root
+            utils.dump_json(ports, self._ports_path)
+            utils.dump_json(host, self._host_ports_path)
+        LOG.debug(f"Allocated ports {ports} under '{self._state_root}'")
+        return ports
+
+
 class SaltMaster(SaltDaemon):
     EXE = "salt-master"
     PIDFILE = "salt-master.pid"
+    SOCK_DIR = "salt/master"
+    READY_SOCKETS = ("master_event_pub.ipc", "master_event_pull.ipc")
 
 
 class SaltMinion(SaltDaemon):
     EXE = "salt-minion"
     PIDFILE = "salt-minion.pid"
+    SOCK_DIR = "salt/minion"
+    READY_SOCKETS = ("minion_event_*_pub.ipc",)
 
 
 # config
 
 
+_OPTS_CACHE = {}
+_OPTS_LOCK = threading.Lock()
+OPTS_LOADERS = {
+    "minion": "minion_config",
+    "master": "master_config",
+    "cloud": "cloud_config",
+}
+
+
+def _config_stamp(path):
+    include_dir = f"{path}.d"
+    paths = [path, include_dir] + sorted(glob.glob(os.path.join(include_dir, "*.conf")))
+    stamp = []
+    for _path in paths:
+        try:
+            stamp.append((_path, os.stat(_path).st_mtime_ns))
+        except FileNotFoundError:
+            continue
+    return tuple(stamp)
+
+
+def load_opts(kind, path):
+    import salt.config
+
+    path = os.path.abspath(path)
+    stamp = _config_stamp(path)
+    with _OPTS_LOCK:
+        cached = _OPTS_CACHE.get((kind, path))
+        if cached is None or cached[0] != stamp:
+            LOG.debug(f"Loading {kind} opts from '{path}'")
+            opts = getattr(salt.config, OPTS_LOADERS[kind])(path)
+            cached = _OPTS_CACHE[(kind, path)] = (stamp, opts)
+    # callers (Caller, CloudClient) mutate their opts
+    return copy.deepcopy(cached[1])
+
+
 class SaltConfig:
     # ROOT_DIR_VAR = "ROOT_DIR"
     # PATTERN = "{ROOT_DIR}/**"
@@ -137,8 +543,6 @@ class SaltConfig:
         if cleanup is None:
             cleanup = False
         self._cleanup = cleanup
-        self._minion_config = None
-        self._master_config = None
 
     @property
     def _minion_config_path(self):
@@ -146,23 +550,19 @@ class SaltConfig:
 
     @property
     def _master_config_path(self):
-        os.path.join(self.config_dir, "master")
+        return os.path.join(self.config_dir, "master")
 
     @property
     def minion_opts(self):
-        if self._minion_config is None:
-            path = self._minion_config_path
-            assert os.path.exists(path), path
-            self._minion_config = salt.config.minion_config(path)
-        return self._minion_config
+        path = self._minion_config_path
+        assert os.path.exists(path), path
+        return load_opts("minion", path)
 
     @property
     def master_opts(self):
-        if self._master_config is None:
-            path = self._master_config_path
-            assert os.path.exists(path)
-            self._master_config = salt.config.master_config(path)
-        return self._minion_config
+        path = self._master_config_path
+        assert os.path.exists(path), path
+        return load_opts("master", path)
 
     @property
     def config_dir(self):
@@ -175,14 +575,18 @@ class SaltConfig:
         return int(open(pid_file).read())
 
     def call_client(self):
+        import salt.client
+
         mopts = self.minion_opts
         # assert 'file_client' in mopts and mopts['file_client'] == 'local'
         return salt.client.Caller(mopts=mopts)
 
     def cloud_client(self):
+        import salt.cloud
+
         cfg_path = os.path.join(self.config_dir, "cloud")
         assert os.path.exists(cfg_path)
-        opts = salt.config.cloud_config(path=cfg_path)
+        opts = load_opts("cloud", cfg_path)
         return salt.cloud.CloudClient(opts=opts)
 
     # def __enter__(self):
@@ -222,3 +626,19 @@ class SaltConfig:
     @classmethod
     def from_env(cls):
         pass
+
+
+DAEMONS = {cls.EXE: cls for cls in (SaltMaster, SaltMinion)}
+
+
+def _reap(exe, config_path, run_path, idle_timeout, released_at):
+    config_obj = types.SimpleNamespace(
+        salt_config_path=config_path, salt_run_path=run_path
+    )
+    daemon = DAEMONS[exe].from_config(config_obj)
+    DaemonSupervisor(daemon, float(idle_timeout)).reap(float(released_at))
+
+
+if __name__ == "__main__":
+    assert sys.argv[1] == "reap", sys.argv
+    _reap(*sys.argv[2:])
@@ -0,0 +1,195 @@
+import contextlib
+import logging
+import os
+import shutil
+import sys
+
+from filelock import FileLock, Timeout
+
+from . import utils
+from .api import SaltBox, SaltBoxConfig, TemplateRenderer
+from .salt_helpers import DAEMONS
+from .template import TemplateIndex, digest_obj
+
+LOG = logging.getLogger(__name__)
+
+
+class SandboxPool:
+    ROOT_ENV = "SALTBOX_SANDBOX_ROOT"
+    READY_FILENAME = ".saltbox-sandbox.json"
+    SNAPSHOT_FILENAME = ".saltbox-sandbox-files.json"
+    # saltbox's own incremental state survives a reset; everything else in the
+    # prefix is put back to how it was right after the last render
+    KEEP_DIRS = (
+        os.path.dirname(SaltBoxConfig.BOX_DEFAULT_REGISTRY_PATH),
+        SaltBoxConfig.BOX_DEFAULT_STATE_PATH,
+        SaltBoxConfig.BOX_DEFAULT_CACHE_PATH,
+    )
+    MAX_SLOTS = 4
+    MAX_KEYS = 16
+
+    def __init__(self, root_dir, max_slots=None, max_keys=None):
+        self._root_dir = root_dir
+        self._max_slots = max_slots or self.MAX_SLOTS
+        self._max_keys = max_keys or self.MAX_KEYS
+
+    @classmethod
+    def from_env(cls, **dargs):
+        root_dir = os.environ.get(cls.ROOT_ENV)
+        if root_dir is None:
+            cache_home = os.environ.get(
+                "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+            )
+            root_dir = os.path.join(cache_home, "saltbox", "sandboxes")
+        return cls(root_dir, **dargs)
+
+    @property
+    def root_dir(self):
+        return self._root_dir
+
+    def _key_dirs(self):
+        if not os.path.isdir(self._root_dir):
+            return []
+        return [
+            os.path.join(self._root_dir, name)
+            for name in os.listdir(self._root_dir)
+            if name != "index" and not name.startswith(".")
+        ]
+
+    def key_for(self, box_path, config):
+        box_path = os.path.abspath(box_path)
+        index = TemplateIndex.from_file(self._root_dir, box_path).refresh()
+        if index.dirty:
+            index.to_file(self._root_dir)
+        return digest_obj([box_path, index.fingerprint, config])
+
+    @staticmethod
+    def _slot_lock(slot_dir):
+        return FileLock(f"{slot_dir}.lock")
+
+    @contextlib.contextmanager
+    def checkout(self, key):
+        key_dir = os.path.join(self._root_dir, key)
+        os.makedirs(key_dir, exist_ok=True)
+        os.utime(key_dir)
+        for slot in range(self._max_slots):
+            slot_dir = os.path.join(key_dir, str(slot))
+            lock = self._slot_lock(slot_dir)
+            try:
+                lock.acquire(timeout=0)
+                break
+            except Timeout:
+                continue
+        else:
+            LOG.debug(f"All {self._max_slots} sandboxes for {key} are busy. Waiting.")
+            slot_dir = os.path.join(key_dir, "0")
+            lock = self._slot_lock(slot_dir)
+            lock.acquire()
+        try:
+            LOG.debug(f"Checked out sandbox '{slot_dir}'")
+            yield slot_dir
+        finally:
+            lock.release()
+        self._prune()
+
+    def _prune(self):
+        key_dirs = sorted(self._key_dirs(), key=os.path.getmtime, reverse=True)
+        for key_dir in key_dirs[self._max_keys:]:
+            with contextlib.ExitStack() as stack:
+                try:
+                    for slot in range(self._max_slots):
+                        lock = self._slot_lock(os.path.join(key_dir, str(slot)))
+                        lock.acquire(timeout=0)
+                        stack.callback(lock.release)
+                except Timeout:
+                    continue
+                LOG.debug(f"Evicting sandboxes '{key_dir}'")
+                shutil.rmtree(key_dir, ignore_errors=True)
+
+    def _config(self, prefix, formula):
+        return SaltBoxConfig.from_env(prefix=prefix,
+                                      bin_prefix=os.path.join(sys.prefix, "bin"),
+                                      use_install_cache=False,
+                                      **formula.config
+                                      )
+
+    def _install(self, prefix, key, box, config):
+        ready_path = os.path.join(prefix, self.READY_FILENAME)
+        if utils.load_json(ready_path, default={}).get("key") == key:
+            return False
+        LOG.debug(f"Installing '{box.path}' into sandbox '{prefix}'")
+        shutil.rmtree(prefix, ignore_errors=True)
+        os.makedirs(prefix)
+        with SaltBox.installer_factory(config) as api:
+            api.add_package(box.path)
+        utils.dump_json(dict(key=key, box=os.path.abspath(box.path)), ready_path)
+        return True
+
+    def _files(self, prefix):
+        files = {}
+        dirs = []
+        for dirpath, dirnames, filenames in os.walk(prefix):
+            rel_dir = os.path.relpath(dirpath, prefix)
+            if rel_dir in self.KEEP_DIRS:
+                dirnames[:] = []
+                continue
+            if rel_dir != os.curdir:
+                dirs.append(rel_dir)
+            for filename in filenames + [d for d in dirnames if os.path.islink(
+                    os.path.join(dirpath, d))]:
+                relpath = os.path.normpath(os.path.join(rel_dir, filename))
+                if relpath in (self.READY_FILENAME, self.SNAPSHOT_FILENAME):
+                    continue
+                file_stat = os.lstat(os.path.join(prefix, relpath))
+                files[relpath] = [file_stat.st_mode, file_stat.st_size,
+                                  file_stat.st_mtime_ns]
+        return files, dirs
+
+    def _snapshot(self, prefix):
+        files, dirs = self._files(prefix)
+        utils.dump_json(dict(files=files, dirs=dirs),
+                        os.path.join(prefix, self.SNAPSHOT_FILENAME))
+
+    def _reset(self, prefix, config):
+        snapshot = utils.load_json(os.path.join(prefix, self.SNAPSHOT_FILENAME))
+        if snapshot is None:
+            return
+        for daemon_cls in DAEMONS.values():
+            daemon = daemon_cls.from_config(config)
+            if daemon.attach():
+                LOG.debug(f"Stopping {daemon.EXE} left running in '{prefix}'")
+                daemon.stop()
+        files, dirs = self._files(prefix)
+        removed = 0
+        for relpath, sig in files.items():
+            if snapshot["files"].get(relpath) != sig:
+                os.unlink(os.path.join(prefix, relpath))
+                removed += 1
+        keep_dirs = set(snapshot["dirs"])
+        for rel_dir in sorted(dirs, reverse=True):
+            if rel_dir not in keep_dirs:
+                shutil.rmtree(os.path.join(prefix, rel_dir), ignore_errors=True)
+        LOG.debug(f"Reset sandbox '{prefix}': removed {removed} changed file(s)")
+
+    def _prepare(self, prefix, key, box, formula):
+        config = self._config(prefix, formula)
+        if not self._install(prefix, key, box, config):
+            self._reset(prefix, config)
+        # restores rendered files the reset removed
+        with TemplateRenderer(config):
+            pass
+        self._snapshot(prefix)
+        return config
+
+    @contextlib.contextmanager
+    def sandbox(self, box, formula):
+        key = self.key_for(box.path, formula.config)
+        with self.checkout(key) as prefix:
+            yield self._prepare(prefix, key, box, formula)
+
+    def warm(self, box, formula, slots=1):
+        key = self.key_for(box.path, formula.config)
+        with contextlib.ExitStack() as stack:
+            for _ in range(min(slots, self._max_slots)):
+                prefix = stack.enter_context(self.checkout(key))
+                self._prepare(prefix, key, box, formula)
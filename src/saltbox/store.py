@@ -0,0 +1,161 @@
+import collections
+import logging
+import os
+import shutil
+import tempfile
+
+from filelock import FileLock
+
+from . import utils
+from .template import TemplateIndex, TemplateSync, digest_obj
+
+LOG = logging.getLogger(__name__)
+
+
+class ContentStore:
+    OBJECTS_DIR = "objects"
+    TREES_DIR = "trees"
+    SOURCES_FILENAME = "sources.json"
+
+    def __init__(self, root_dir, max_bytes=None):
+        self._root_dir = root_dir
+        self._max_bytes = max_bytes
+        self._strategies = collections.Counter()
+
+    @property
+    def _objects_dir(self):
+        return os.path.join(self._root_dir, self.OBJECTS_DIR)
+
+    @property
+    def _trees_dir(self):
+        return os.path.join(self._root_dir, self.TREES_DIR)
+
+    @property
+    def _sources_path(self):
+        return os.path.join(self._root_dir, self.SOURCES_FILENAME)
+
+    def lock(self):
+        os.makedirs(self._root_dir, exist_ok=True)
+        return FileLock(os.path.join(self._root_dir, "store.lock"))
+
+    def tree_for(self, package_dir):
+        sources = utils.load_json(self._sources_path, default={})
+        tree_dir = sources.get(os.path.abspath(package_dir))
+        if tree_dir is None or not os.path.isdir(tree_dir):
+            return None
+        return tree_dir
+
+    def _object_path(self, key):
+        return os.path.join(self._objects_dir, key[:2], key[2:])
+
+    def _add_object(self, src_path, key, mode):
+        object_path = self._object_path(key)
+        if os.path.exists(object_path):
+            return object_path
+        dirname = os.path.dirname(object_path)
+        os.makedirs(dirname, exist_ok=True)
+        tmp_path = os.path.join(dirname, f".tmp-{os.getpid()}-{key}")
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        try:
+            strategy = TemplateSync.copy_file(src_path, tmp_path)
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._strategies[strategy] += 1
+        return object_path
+
+    def add_tree(self, package_dir):
+        package_dir = os.path.abspath(package_dir)
+        with self.lock():
+            index = TemplateIndex.from_file(self._root_dir, package_dir).refresh()
+            if index.dirty:
+                index.to_file(self._root_dir)
+            entries = {}
+            for relpath, entry in index.files.items():
+                # objects are shared through hardlinks, so they are never writable;
+                # the source mode is kept in the tree's modes file for publishing
+                mode = entry["mode"] & ~0o222
+                entries[relpath] = [f"{entry['digest']}-{mode:o}", mode, entry["mode"]]
+            tree_hash = digest_obj([index.dirs, entries])
+            tree_dir = os.path.join(self._trees_dir, tree_hash)
+            if os.path.isdir(tree_dir):
+                LOG.debug(f"'{package_dir}' is unchanged. Reusing '{tree_dir}'.")
+            else:
+                self._build_tree(package_dir, tree_dir, index.dirs, entries)
+            os.utime(tree_dir)
+            sources = utils.load_json(self._sources_path, default={})
+            sources[package_dir] = tree_dir
+            utils.dump_json(sources, self._sources_path)
+        return tree_dir
+
+    def _build_tree(self, package_dir, tree_dir, dirs, entries):
+        LOG.debug(f"Caching '{package_dir}' -> '{tree_dir}'")
+        self._strategies = collections.Counter()
+        os.makedirs(self._trees_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self._trees_dir, prefix=".tmp-")
+        try:
+            for rel_dir in dirs:
+                os.makedirs(os.path.join(tmp_dir, rel_dir), exist_ok=True)
+            modes = {}
+            for relpath, (key, mode, src_mode) in entries.items():
+                src_path = os.path.join(package_dir, relpath)
+                object_path = self._add_object(src_path, key, mode)
+                os.link(object_path, os.path.join(tmp_dir, relpath))
+                modes[relpath] = src_mode
+            utils.dump_json(modes, os.path.join(tmp_dir, TemplateIndex.MODES_FILENAME))
+            os.rename(tmp_dir, tree_dir)
+            LOG.debug(f"Cached '{package_dir}': {dict(self._strategies)}")
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    @property
+    def size(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self._objects_dir):
+            total += sum(os.lstat(os.path.join(dirpath, f)).st_size for f in filenames)
+        return total
+
+    def _collect_garbage(self):
+        freed = 0
+        for dirpath, _, filenames in os.walk(self._objects_dir):
+            for filename in filenames:
+                object_path = os.path.join(dirpath, filename)
+                object_stat = os.lstat(object_path)
+                if object_stat.st_nlink == 1:
+                    os.unlink(object_path)
+                    freed += object_stat.st_size
+        return freed
+
+    def evict(self, keep=()):
+        if self._max_bytes is None or not os.path.isdir(self._trees_dir):
+            return
+        keep = {os.path.abspath(tree_dir) for tree_dir in keep}
+        with self.lock():
+            size = self.size
+            if size <= self._max_bytes:
+                return
+            trees = (
+                os.path.join(self._trees_dir, name)
+                for name in os.listdir(self._trees_dir)
+                if not name.startswith(".")
+            )
+            trees = sorted((t for t in trees if t not in keep), key=os.path.getmtime)
+            sources = utils.load_json(self._sources_path, default={})
+            for tree_dir in trees:
+                LOG.debug(f"Evicting '{tree_dir}' from the install cache")
+                shutil.rmtree(tree_dir)
+                size -= self._collect_garbage()
+                if size <= self._max_bytes:
+                    break
+            sources = {s: t for s, t in sources.items() if os.path.isdir(t)}
+            utils.dump_json(sources, self._sources_path)
+        if size > self._max_bytes:
+            LOG.warning(
+                f"Install cache is {size} bytes, over its {self._max_bytes} byte "
+                "budget, but every remaining tree is registered"
+            )
@@ -1,19 +1,506 @@
-import distutils.dir_util
+import collections
+import concurrent.futures
+import filecmp
+import functools
 import glob
+import hashlib
+import json
+import logging
 import os
-
-import jinja2
+import shutil
+import stat
+import tempfile
 import warnings
 
+from filelock import FileLock
+
+from . import utils
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+LOG = logging.getLogger(__name__)
+
+
+def scan_file(path, markers=()):
+    hsh = hashlib.sha1()
+    found = False
+    tail = b""
+    overlap = max((len(marker) for marker in markers), default=1) - 1
+    with open(path, "rb") as src_file:
+        for chunk in iter(lambda: src_file.read(1 << 16), b""):
+            hsh.update(chunk)
+            if not found and len(markers) > 0:
+                window = tail + chunk
+                found = any(marker in window for marker in markers)
+                tail = window[-overlap:] if overlap > 0 else b""
+    return hsh.hexdigest(), found
+
+
+def digest_file(path):
+    return scan_file(path)[0]
+
+
+def digest_obj(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
 
 class TemplateSync:
+    FICLONE = 0x40049409
+    _NO_REFLINK = set()
+
     @classmethod
     def copy_tree(cls, src_path, dst_path):
         assert os.path.exists(src_path), src_path
         assert os.path.isdir(src_path), src_path
         assert os.path.exists(dst_path), dst_path
         assert os.path.isdir(dst_path), dst_path
-        distutils.dir_util.copy_tree(src_path, dst_path)
+        strategies = collections.Counter()
+        for dirpath, _, filenames in os.walk(src_path, followlinks=True):
+            dst_dir = os.path.join(dst_path, os.path.relpath(dirpath, src_path))
+            os.makedirs(dst_dir, exist_ok=True)
+            for filename in filenames:
+                dst_file = os.path.join(dst_dir, filename)
+                if os.path.lexists(dst_file):
+                    os.unlink(dst_file)
+                src_file = os.path.join(dirpath, filename)
+                strategies[cls.copy_file(src_file, dst_file)] += 1
+        LOG.debug(f"Copied '{src_path}' -> '{dst_path}': {dict(strategies)}")
+        return strategies
+
+    @classmethod
+    def copy_file(cls, src_path, dst_path):
+        src_stat = os.stat(src_path)
+        dst_dev = os.stat(os.path.dirname(dst_path) or os.curdir).st_dev
+        if cls._reflink(src_path, dst_path, (src_stat.st_dev, dst_dev)):
+            strategy = "reflink"
+        elif cls._copy_range(src_path, dst_path, src_stat.st_size):
+            strategy = "copy_file_range"
+        else:
+            shutil.copyfile(src_path, dst_path)
+            strategy = "copy"
+        shutil.copystat(src_path, dst_path)
+        return strategy
+
+    @classmethod
+    def _reflink(cls, src_path, dst_path, devices):
+        if fcntl is None or devices in cls._NO_REFLINK:
+            return False
+        with open(src_path, "rb") as src_file, open(dst_path, "wb") as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), cls.FICLONE, src_file.fileno())
+                return True
+            except OSError:
+                cls._NO_REFLINK.add(devices)
+        os.unlink(dst_path)
+        return False
+
+    @staticmethod
+    def _copy_range(src_path, dst_path, size):
+        if not hasattr(os, "copy_file_range"):
+            return False
+        with open(src_path, "rb") as src_file, open(dst_path, "wb") as dst_file:
+            try:
+                while size > 0:
+                    copied = os.copy_file_range(
+                        src_file.fileno(), dst_file.fileno(), size
+                    )
+                    if copied == 0:
+                        break
+                    size -= copied
+                return True
+            except OSError:
+                pass
+        os.unlink(dst_path)
+        return False
+
+    @classmethod
+    def link_file(cls, src_path, dst_path, mode=None):
+        try:
+            if not os.path.samefile(src_path, dst_path) and filecmp.cmp(
+                src_path, dst_path, shallow=False
+            ):
+                if mode is not None and stat.S_IMODE(os.stat(dst_path).st_mode) != mode:
+                    os.chmod(dst_path, mode)
+                return None
+        except FileNotFoundError:
+            pass
+        dirname = os.path.dirname(dst_path)
+        os.makedirs(dirname, exist_ok=True)
+        tmp_name = f".saltbox-{os.getpid()}-{os.path.basename(dst_path)}"
+        tmp_path = os.path.join(dirname, tmp_name)
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        try:
+            strategy = cls.copy_file(src_path, tmp_path)
+            if mode is not None:
+                os.chmod(tmp_path, mode)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return strategy
+
+    @classmethod
+    def merge_file(cls, contents, dst_path, mode):
+        mode = stat.S_IMODE(mode)
+        try:
+            dst_stat = os.stat(dst_path)
+        except FileNotFoundError:
+            dst_stat = None
+        if dst_stat is not None and dst_stat.st_size == len(contents):
+            with open(dst_path, "rb") as dst_file:
+                if dst_file.read() == contents:
+                    if stat.S_IMODE(dst_stat.st_mode) != mode:
+                        os.chmod(dst_path, mode)
+                    return False
+        dirname = os.path.dirname(dst_path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".saltbox-")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(contents)
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
+
+
+class TemplateIndex:
+    MARKERS = (b"{{$", b"((*", b"((=")
+    # written by ContentStore: the source modes of a tree of read-only objects
+    MODES_FILENAME = ".saltbox-modes.json"
+    _PARSE_ENV = None
+
+    def __init__(self, root_dir, files=None, dirs=None):
+        self._root_dir = root_dir
+        self._files = files or {}
+        self._dirs = dirs or []
+        self._dirty = False
+
+    @property
+    def root_dir(self):
+        return self._root_dir
+
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def dirs(self):
+        return self._dirs
+
+    @property
+    def templates(self):
+        return {r for r, entry in self._files.items() if entry["template"]}
+
+    @property
+    def fingerprint(self):
+        # a chmod leaves the stat sig alone, so the mode is hashed in separately
+        digests = {
+            relpath: [entry["digest"], entry["mode"]]
+            for relpath, entry in self._files.items()
+        }
+        return digest_obj([self._dirs, digests])
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def refresh(self):
+        files = {}
+        dirs = []
+        modes = utils.load_json(
+            os.path.join(self._root_dir, self.MODES_FILENAME), default={}
+        )
+        for dirpath, _, filenames in os.walk(self._root_dir, followlinks=True):
+            rel_dir = os.path.relpath(dirpath, self._root_dir)
+            if rel_dir != os.curdir:
+                dirs.append(rel_dir)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relpath = os.path.normpath(os.path.join(rel_dir, filename))
+                if not os.path.isfile(path) or relpath == self.MODES_FILENAME:
+                    continue
+                src_stat = os.stat(path)
+                sig = [src_stat.st_size, src_stat.st_mtime_ns]
+                entry = self._files.get(relpath)
+                if entry is None or entry["stat"] != sig or "deps" not in entry:
+                    entry = self._scan(path, relpath, sig)
+                mode = modes.get(relpath, stat.S_IMODE(src_stat.st_mode))
+                if entry.get("mode") != mode:
+                    entry = dict(entry, mode=mode)
+                files[relpath] = entry
+        dirs.sort()
+        self._dirty = self._dirty or files != self._files or dirs != self._dirs
+        self._files = files
+        self._dirs = dirs
+        return self
+
+    def _scan(self, path, relpath, sig):
+        digest, template = scan_file(path, self.MARKERS)
+        template = template and not self.is_hidden(relpath)
+        deps = self._find_deps(path) if template else []
+        return dict(stat=sig, digest=digest, template=template, deps=deps)
+
+    @classmethod
+    def _find_deps(cls, path):
+        import jinja2.meta
+
+        if cls._PARSE_ENV is None:
+            cls._PARSE_ENV = RecipeTemplate.environment()
+        try:
+            with open(path, encoding="utf-8") as src_file:
+                ast = cls._PARSE_ENV.parse(src_file.read())
+        except Exception:
+            return []
+        # None marks a dynamic include/import that cannot be resolved statically
+        return sorted(
+            jinja2.meta.find_referenced_templates(ast), key=lambda n: (n is None, n)
+        )
+
+    def dependencies(self, relpath):
+        deps = self._files[relpath]["deps"]
+        return [None if dep is None else os.path.normpath(dep) for dep in deps]
+
+    def dependents(self, relpath):
+        reverse = {}
+        for other in self._files:
+            for dep in self.dependencies(other):
+                reverse.setdefault(dep, set()).add(other)
+        dynamic = reverse.get(None, set())
+        found = set()
+        queue = [relpath]
+        while len(queue) > 0:
+            for other in reverse.get(queue.pop(), set()).union(dynamic):
+                if other not in found:
+                    found.add(other)
+                    queue.append(other)
+        found.discard(relpath)
+        return found
+
+    @property
+    def graph(self):
+        return {
+            relpath: self.dependencies(relpath)
+            for relpath in sorted(self._files)
+            if len(self._files[relpath]["deps"]) > 0
+        }
+
+    def effective_digests(self):
+        memo = {}
+        fingerprint = None
+
+        def visit(relpath, stack):
+            nonlocal fingerprint
+            if relpath in memo:
+                return memo[relpath]
+            entry = self._files.get(relpath)
+            if entry is None:
+                return None
+            deps = self.dependencies(relpath)
+            if relpath in stack or len(deps) == 0:
+                return entry["digest"]
+            if None in deps:
+                if fingerprint is None:
+                    fingerprint = self.fingerprint
+                parts = [entry["digest"], fingerprint]
+            else:
+                parts = [entry["digest"]] + [visit(d, stack | {relpath}) for d in deps]
+            memo[relpath] = digest_obj(parts)
+            return memo[relpath]
+
+        return {relpath: visit(relpath, frozenset()) for relpath in sorted(self._files)}
+
+    @staticmethod
+    def overlay(indexes):
+        # later roots shadow earlier ones, exactly as the old rsync pass did
+        winners = {}
+        for index in indexes:
+            winners.update(dict.fromkeys(index.files, index))
+        return winners
+
+    @staticmethod
+    def is_hidden(relpath):
+        # glob(PATTERN) never matched dot-files, so they were copied verbatim
+        return any(part.startswith(".") for part in relpath.split(os.sep))
+
+    @classmethod
+    def index_path(cls, state_root, root_dir):
+        hsh = hashlib.md5(os.path.abspath(root_dir).encode()).hexdigest()
+        return os.path.join(state_root, "index", f"{hsh}.json")
+
+    @classmethod
+    def from_file(cls, state_root, root_dir):
+        blob = utils.load_json(cls.index_path(state_root, root_dir), default={})
+        if blob.get("root_dir") != root_dir:
+            blob = {}
+        return cls(root_dir, files=blob.get("files"), dirs=blob.get("dirs"))
+
+    def to_file(self, state_root):
+        blob = dict(root_dir=self._root_dir, files=self._files, dirs=self._dirs)
+        utils.dump_json(blob, self.index_path(state_root, self._root_dir))
+        self._dirty = False
+
+
+class RenderManifest:
+    def __init__(self, blob=None):
+        blob = blob or {}
+        self._vars = blob.get("vars")
+        self._roots = blob.get("roots", [])
+        self._outputs = blob.get("outputs", {})
+
+    @staticmethod
+    def _contributions(indexes):
+        winners = {}
+        for index in indexes:
+            for relpath, digest in index.effective_digests().items():
+                mode = index.files[relpath]["mode"]
+                winners[relpath] = [index.root_dir, digest, mode]
+        return {relpath: digest_obj(winner) for relpath, winner in winners.items()}
+
+    @staticmethod
+    def _roots_of(indexes):
+        return [[index.root_dir, index.fingerprint] for index in indexes]
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+    @property
+    def generation(self):
+        return digest_obj([self._vars, self._roots])
+
+    def missing(self, salt_root):
+        return {
+            r for r in self._outputs if not os.path.exists(os.path.join(salt_root, r))
+        }
+
+    def changed(self, target, salt_root):
+        if self._vars != target._vars:
+            return set(target.outputs)
+        stale = set()
+        if self._roots != target._roots:
+            stale = {
+                r for r, fp in target.outputs.items() if self._outputs.get(r) != fp
+            }
+        return stale.union(target.missing(salt_root))
+
+    def update(self, indexes, template_vars):
+        self._vars = digest_obj(template_vars)
+        self._roots = self._roots_of(indexes)
+        self._outputs = self._contributions(indexes)
+
+    @classmethod
+    def from_indexes(cls, indexes, template_vars):
+        manifest = cls()
+        manifest.update(indexes, template_vars)
+        return manifest
+
+    @classmethod
+    def from_file(cls, manifest_path):
+        return cls(utils.load_json(manifest_path))
+
+    def to_file(self, manifest_path):
+        blob = dict(vars=self._vars, roots=self._roots, outputs=self._outputs)
+        utils.dump_json(blob, manifest_path)
+
+
+class GenerationStore:
+    KEEP = 4
+
+    def __init__(self, state_root):
+        self._state_root = state_root
+
+    @property
+    def _generations_dir(self):
+        return os.path.join(self._state_root, "generations")
+
+    @property
+    def _current_path(self):
+        return os.path.join(self._state_root, "current")
+
+    def lock(self):
+        os.makedirs(self._state_root, exist_ok=True)
+        return FileLock(os.path.join(self._state_root, "render.lock"))
+
+    def current(self):
+        try:
+            target = os.readlink(self._current_path)
+        except FileNotFoundError:
+            return RenderManifest()
+        return RenderManifest.from_file(os.path.join(self._state_root, target))
+
+    def publish(self, manifest):
+        name = f"{manifest.generation}.json"
+        generation_path = os.path.join(self._generations_dir, name)
+        if not os.path.exists(generation_path):
+            manifest.to_file(generation_path)
+        tmp_link = f"{self._current_path}.{os.getpid()}"
+        os.symlink(os.path.join("generations", name), tmp_link)
+        os.replace(tmp_link, self._current_path)
+        self._prune(keep=name)
+
+    def _prune(self, keep):
+        paths = glob.glob(os.path.join(self._generations_dir, "*.json"))
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[self.KEEP:]:
+            if os.path.basename(path) != keep:
+                os.unlink(path)
+
+
+ROOT_SEP = "::"
+
+
+@functools.lru_cache(maxsize=None)
+def _environment_classes():
+    # jinja2 is only imported once something renders or parses a template
+    import jinja2
+
+    class RootLoader(jinja2.BaseLoader):
+        SEP = ROOT_SEP
+
+        def __init__(self):
+            self._loaders = {}
+
+        def get_source(self, environment, template):
+            root_dir, _, relpath = template.partition(self.SEP)
+            if root_dir not in self._loaders:
+                self._loaders[root_dir] = jinja2.FileSystemLoader(root_dir)
+            return self._loaders[root_dir].get_source(environment, relpath)
+
+    class RecipeEnvironment(jinja2.Environment):
+        def join_path(self, template, parent):
+            # includes/imports resolve against the including template's root
+            root_dir, sep, _ = parent.partition(ROOT_SEP)
+            return f"{root_dir}{sep}{template}"
+
+    return dict(RootLoader=RootLoader, RecipeEnvironment=RecipeEnvironment)
+
+
+def __getattr__(name):
+    if name in ("RootLoader", "RecipeEnvironment"):
+        return _environment_classes()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+_WORKER_STATE = {}
+
+
+def _init_render_worker(bytecode_cache_path, template_vars):
+    _WORKER_STATE["jinja_env"] = RecipeTemplate.environment(bytecode_cache_path)
+    _WORKER_STATE["template_vars"] = template_vars
+
+
+def _render_in_worker(job):
+    root_dir, relpath = job
+    template = RecipeTemplate(root_dir, _WORKER_STATE["jinja_env"])
+    return template.render_bytes(relpath, _WORKER_STATE["template_vars"])
 
 
 class RecipeTemplate(TemplateSync):
@@ -21,32 +508,60 @@ class RecipeTemplate(TemplateSync):
     PATTERN = (
         "{ROOT_DIR}/**"
     )  # FIXME (br) this should be narrowed to only certain files
+    PARALLEL_THRESHOLD = 64
 
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, jinja_env=None):
         self._root_dir = root_dir
+        self._jinja_env = jinja_env
+
+    @classmethod
+    def environment(cls, bytecode_cache_path=None):
+        import jinja2
+
+        classes = _environment_classes()
+        bytecode_cache = None
+        if bytecode_cache_path is not None:
+            os.makedirs(bytecode_cache_path, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_path)
+        return classes["RecipeEnvironment"](
+            loader=classes["RootLoader"](),
+            bytecode_cache=bytecode_cache,
+            block_start_string="((*",  # FIXME (br) this is unused
+            block_end_string="*))",  # FIXME (br)
+            variable_start_string="{{$",
+            variable_end_string="$}}",
+            comment_start_string="((=",  # FIXME (br)
+            comment_end_string="=))",  # FIXME (br)
+        )
 
     @property
     def jinja_env(self):
-        j_env = jinja2.Environment(loader=jinja2.FileSystemLoader(self._root_dir))
-        j_env.block_start_string = "((*"  # FIXME (br) this is unused
-        j_env.block_end_string = "*))"  # FIXME (br)
-        j_env.variable_start_string = "{{$"
-        j_env.variable_end_string = "$}}"
-        j_env.comment_start_string = "((="  # FIXME (br)
-        j_env.comment_end_string = "=))"  # FIXME (br)
-        return j_env
+        if self._jinja_env is None:
+            self._jinja_env = self.environment()
+        return self._jinja_env
 
-    def _render_one_inplace(self, possible_template, template_vars):
-        env_path = os.path.relpath(possible_template, self._root_dir)
+    def _template_name(self, env_path):
+        return f"{self._root_dir}{ROOT_SEP}{env_path}"
+
+    def _render_one(self, env_path, template_vars):
         try:
-            new_contents = self.jinja_env.get_template(env_path).render(**template_vars)
+            template = self.jinja_env.get_template(self._template_name(env_path))
+            return template.render(**template_vars)
         except Exception:
             warnings.warn(f"JINJA rendering failed for {env_path}")
+            return None
+
+    def _render_one_inplace(self, possible_template, template_vars):
+        env_path = os.path.relpath(possible_template, self._root_dir)
+        new_contents = self._render_one(env_path, template_vars)
+        if new_contents is None:
             return
         with open(possible_template, "w") as rendered_template:
             rendered_template.write(new_contents)
 
     def _render_inplace(self, template_vars):
+        import jinja2
+
         pattern = self.PATTERN.format(ROOT_DIR=self._root_dir)
         matches = glob.iglob(pattern, recursive=True)
         for possible_template in matches:
@@ -58,13 +573,98 @@ class RecipeTemplate(TemplateSync):
                 print(possible_template)
                 raise
 
+    def relpaths(self):
+        for dirpath, _, filenames in os.walk(self._root_dir, followlinks=True):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.isfile(path):
+                    yield os.path.relpath(path, self._root_dir)
+
+    def render_bytes(self, relpath, template_vars):
+        new_contents = None
+        if not TemplateIndex.is_hidden(relpath):
+            new_contents = self._render_one(relpath, template_vars)
+        if new_contents is None:
+            with open(os.path.join(self._root_dir, relpath), "rb") as src_file:
+                return src_file.read()
+        return new_contents.encode()
+
+    def render_file(self, relpath, dst_root, template_vars):
+        src_path = os.path.join(self._root_dir, relpath)
+        contents = self.render_bytes(relpath, template_vars)
+        mode = os.stat(src_path).st_mode
+        return self.merge_file(contents, os.path.join(dst_root, relpath), mode)
+
+    def compile(self, relpaths=None):
+        compiled = 0
+        if relpaths is None:
+            relpaths = self.relpaths()
+        for relpath in relpaths:
+            if TemplateIndex.is_hidden(relpath):
+                continue
+            try:
+                self.jinja_env.get_template(self._template_name(relpath))
+            except Exception:
+                continue
+            compiled += 1
+        return compiled
+
     def render(self, template_vars):
         self._render_inplace(template_vars)
 
     @classmethod
-    def render_to_path(cls, src_path, dst_path, template_vars=None):
+    def render_many(
+        cls,
+        jobs,
+        template_vars,
+        bytecode_cache_path=None,
+        workers=1,
+        parallel_threshold=None,
+    ):
+        if parallel_threshold is None:
+            parallel_threshold = cls.PARALLEL_THRESHOLD
+        # results come back in job order as soon as each one is ready, so the
+        # caller merges files while the rest are still rendering
+        if workers <= 1 or len(jobs) < parallel_threshold:
+            jinja_env = cls.environment(bytecode_cache_path)
+            return (
+                cls(root_dir, jinja_env).render_bytes(relpath, template_vars)
+                for root_dir, relpath in jobs
+            )
+        chunksize = max(1, len(jobs) // (workers * 4))
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_render_worker,
+            initargs=(bytecode_cache_path, template_vars),
+        )
+        try:
+            # map() submits every job right away
+            results = pool.map(_render_in_worker, jobs, chunksize=chunksize)
+        except BaseException:
+            pool.shutdown()
+            raise
+        drain = cls._drain(pool, results)
+        next(drain)
+        return drain
+
+    @staticmethod
+    def _drain(pool, results):
+        # primed by the caller, so closing it early still shuts the pool down
+        with pool:
+            yield
+            yield from results
+
+    @classmethod
+    def render_to_path(
+        cls, src_path, dst_path, template_vars=None, relpaths=None, jinja_env=None
+    ):
         template_vars = template_vars or {}
         assert isinstance(template_vars, dict)
-        cls.copy_tree(src_path, dst_path)
-        cls(dst_path).render(template_vars)
+        if relpaths is None:
+            cls.copy_tree(src_path, dst_path)
+            cls(dst_path, jinja_env).render(template_vars)
+            return dst_path
+        template = cls(src_path, jinja_env)
+        for relpath in relpaths:
+            template.render_file(relpath, dst_path, template_vars)
         return dst_path
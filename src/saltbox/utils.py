@@ -1,16 +1,23 @@
+import functools
+import json
 import os
 import re
+import stat
+import tempfile
 
 import yaml
 
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
+
+@functools.lru_cache(maxsize=None)
 def loader_factory():
     path_matcher = re.compile(r".*\$\{([^}^{]+)\}.*")
 
     def path_constructor(loader, node):
         return os.path.expandvars(node.value)
 
-    class EnvVarLoader(yaml.SafeLoader):
+    class EnvVarLoader(SafeLoader):
         pass
 
     EnvVarLoader.add_implicit_resolver("!path", path_matcher, None)
@@ -19,4 +26,42 @@ def loader_factory():
 
 
 def load_yaml(path):
-    return yaml.load(open(path), Loader=loader_factory())
+    with open(path) as yaml_file:
+        return yaml.load(yaml_file, Loader=loader_factory())
+
+
+def load_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def dump_json(obj, path):
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    with os.fdopen(fd, "w") as json_file:
+        json.dump(obj, json_file, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def runtime_dir():
+    # per-user home for sockets and host-level state
+    return os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+        tempfile.gettempdir(), f"saltbox-{os.getuid()}"
+    )
+
+
+def private_dir(path):
+    # a directory another user could have created first is refused, not trusted
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    dir_stat = os.lstat(path)
+    if (
+        not stat.S_ISDIR(dir_stat.st_mode)
+        or dir_stat.st_uid != os.getuid()
+        or stat.S_IMODE(dir_stat.st_mode) & 0o077
+    ):
+        raise PermissionError(f"'{path}' is not private to uid {os.getuid()}")
+    return path
@@ -7,15 +7,12 @@ import argparse
 import json
 import shlex
 import sys
-import jinja2
 import types
 # import site
 import glob
 import functools
-import rich.console
-import rich.table
-import salt.log
 
+from . import utils
 from .api import SaltBox, SaltBoxConfig
 from .formula import Box
 
@@ -23,10 +20,17 @@ cli_entrypoint = plugnparse.entrypoint
 LOG = logging.getLogger(__name__)
 
 def logging_config(log_level):
-    salt.log.setup_console_logger(log_level) if log_level else None
+    if log_level:
+        import salt.log
+
+        salt.log.setup_console_logger(log_level)
 
 class Venv:
     GLOB = "{path}/*/saltbox.yaml"
+    INDEX_FILENAME = "boxes.json"
+
+    def __init__(self):
+        self._index = None
 
     def find_yaml(self, search_path):
         return glob.glob(self.GLOB.format(path=search_path))
@@ -62,16 +66,83 @@ class Venv:
 
     @property
     def boxes(self):
-        return dict(zip(self.box_names, self._boxes))
+        return {name: self.box(name) for name in self.index}
 
     @classmethod
     def box_from_path(self, path):
         return Box.from_path(path)
 
+    def box(self, name):
+        return self.box_from_path(self.index[name]["path"])
+
+    @property
+    def index_path(self):
+        return os.path.join(
+            sys.prefix, SaltBoxConfig.BOX_DEFAULT_CACHE_PATH, self.INDEX_FILENAME
+        )
+
+    def _path_stamp(self):
+        stamp = []
+        for path in self.site_package_paths:
+            try:
+                stamp.append([path, os.stat(path).st_mtime_ns])
+            except OSError:
+                stamp.append([path, None])
+        return stamp
+
+    @staticmethod
+    def _yaml_stamp(yaml_path):
+        try:
+            yaml_stat = os.stat(yaml_path)
+        except OSError:
+            return None
+        return [yaml_stat.st_mtime_ns, yaml_stat.st_size]
+
+    def _load_index(self):
+        blob = utils.load_json(self.index_path, default={})
+        if blob.get("paths") != self._path_stamp():
+            return None
+        boxes = blob.get("boxes", {})
+        for entry in boxes.values():
+            yaml_path = os.path.join(entry["path"], Box._MANIFEST_FILENAME)
+            if self._yaml_stamp(yaml_path) != entry["yaml"]:
+                return None
+        return boxes
+
+    def _build_index(self):
+        paths = self._path_stamp()
+        boxes = {}
+        for yaml_path in self.yamls:
+            box = self.box_from_path(os.path.dirname(yaml_path))
+            boxes[os.path.basename(box.path)] = dict(
+                path=box.path,
+                yaml=self._yaml_stamp(yaml_path),
+                name=box.name,
+                formulas=[[name, formula.descr] for name, formula in
+                          box.manifest.formulas.items()],
+            )
+        try:
+            utils.dump_json(dict(paths=paths, boxes=boxes), self.index_path)
+        except OSError:
+            LOG.debug(f"Cannot write the box index to '{self.index_path}'")
+        return boxes
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self._load_index()
+        if self._index is None:
+            LOG.debug("Box index is stale. Rebuilding.")
+            self._index = self._build_index()
+        return self._index
+
 def _venv_list_args(parser):
     pass
 
 def _show_table(data, header):
+    import rich.console
+    import rich.table
+
     console = rich.console.Console()
     table = rich.table.Table(show_header=True)
     [table.add_column(col_name) for col_name in header]
@@ -83,9 +154,9 @@ def _venv_list(parser, log_level):
     logging_config(log_level)
     table_data = []
     header = ["Box", "Formula", "Description", "saltenv"]
-    for box_name, box_obj in Venv.from_env().boxes.items():
-        for formula_name, formula_obj in box_obj.manifest.formulas.items():
-            table_data.append((box_name, formula_name, formula_obj.descr, box_obj.name, ))
+    for box_name, entry in Venv.from_env().index.items():
+        for formula_name, descr in entry["formulas"]:
+            table_data.append((box_name, formula_name, descr, entry["name"], ))
     _show_table(table_data, header)
 
 def _venv_exec_args(parser):
@@ -96,7 +167,7 @@ def _venv_exec_args(parser):
 @cli_entrypoint(["venv", "exec"], args=_venv_exec_args)
 def _venv_exec(parser, log_level, box_name, formula_name, exec_args):
     logging_config(log_level)
-    box = Venv.from_env().boxes[box_name]
+    box = Venv.from_env().box(box_name)
     assert formula_name in box.manifest.formulas, box.manifest.formulas
     with tempfile.TemporaryDirectory() as tmp_dir:
         formula = box.manifest.formulas[formula_name]
@@ -0,0 +1,281 @@
+import array
+import hashlib
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from filelock import FileLock, Timeout
+
+from . import utils
+
+LOG = logging.getLogger(__name__)
+
+SCRIPTS = {"salt-call": "salt.scripts:salt_call", "salt-run": "salt.scripts:salt_run"}
+HEADER = struct.Struct("!I")
+PEERCRED = struct.Struct("3i")
+STDIO = (0, 1, 2)
+
+
+def _recv_exactly(conn, size):
+    chunks = []
+    while size > 0:
+        chunk = conn.recv(size)
+        if not chunk:
+            raise ConnectionError("worker connection closed early")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _send_fds(sock, data, fds):
+    # socket.send_fds/recv_fds only exist from python 3.9
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    return sock.sendmsg([data], ancdata)
+
+
+def _recv_fds(sock, size, maxfds):
+    fds = array.array("i")
+    data, ancdata, _, _ = sock.recvmsg(
+        size, socket.CMSG_LEN(maxfds * fds.itemsize)
+    )
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            cmsg_data = cmsg_data[: len(cmsg_data) - (len(cmsg_data) % fds.itemsize)]
+            fds.frombytes(cmsg_data)
+    return data, list(fds)
+
+
+def socket_path(run_path):
+    # sandbox prefixes easily push a socket under the run path past the 107 byte
+    # AF_UNIX limit, so the socket lives in a short per-user directory instead
+    digest = hashlib.sha1(os.path.abspath(run_path).encode()).hexdigest()[:16]
+    return os.path.join(utils.runtime_dir(), f"saltbox-worker-{digest}.sock")
+
+
+def _entry_point(name):
+    module, _, attr = SCRIPTS[name].partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def _peer_uid(conn):
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+    return PEERCRED.unpack(creds)[1]
+
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+class WorkerServer:
+    def __init__(self, socket_path, idle_timeout):
+        self._socket_path = socket_path
+        self._idle_timeout = idle_timeout
+        self._listener = None
+
+    def _preload(self):
+        # forked requests inherit the imports; configs are still read per request
+        for name in SCRIPTS:
+            _entry_point(name)
+
+    def serve(self):
+        utils.private_dir(os.path.dirname(self._socket_path))
+        lock = FileLock(f"{self._socket_path}.lock")
+        try:
+            lock.acquire(timeout=0)
+        except Timeout:
+            LOG.debug(f"A worker is already serving '{self._socket_path}'")
+            return False
+        try:
+            self._preload()
+            if os.path.lexists(self._socket_path):
+                os.unlink(self._socket_path)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(self._socket_path)
+            self._listener.listen(64)
+            self._listener.settimeout(self._idle_timeout)
+            # children are never waited on here; their client reports the exit
+            signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+            while True:
+                try:
+                    conn, _ = self._listener.accept()
+                except socket.timeout:
+                    break
+                with conn:
+                    conn.settimeout(None)
+                    self._fork(conn)
+        finally:
+            if self._listener is not None:
+                self._listener.close()
+                os.unlink(self._socket_path)
+            lock.release()
+        return True
+
+    def _fork(self, conn):
+        if _peer_uid(conn) != os.getuid():
+            LOG.error(f"Refusing a worker request from uid {_peer_uid(conn)}")
+            return
+        fds = []
+        try:
+            header, fds = _recv_fds(conn, HEADER.size, len(STDIO))
+            (size,) = HEADER.unpack(header)
+            request = json.loads(_recv_exactly(conn, size))
+        except (OSError, ValueError, struct.error):
+            LOG.exception("Dropping malformed worker request")
+            for fd in fds:
+                os.close(fd)
+            return
+        pid = os.fork()
+        if pid == 0:
+            retcode = 1
+            try:
+                self._listener.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                conn.sendall(json.dumps({"pid": os.getpid()}).encode() + b"\n")
+                retcode = self._run(request, fds)
+            except BaseException:
+                LOG.exception(f"Worker failed running {request.get('argv')}")
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    conn.sendall(json.dumps({"retcode": retcode}).encode() + b"\n")
+                finally:
+                    os._exit(retcode & 0xFF)
+        for fd in fds:
+            os.close(fd)
+
+    def _run(self, request, fds):
+        for target, fd in zip(STDIO, fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = list(request["argv"])
+        script = _entry_point(os.path.basename(sys.argv[0]))
+        try:
+            script()
+        except SystemExit as exc:
+            return _exit_code(exc.code)
+        return 0
+
+
+class WorkerClient:
+    START_TIMEOUT = 30
+    IDLE_TIMEOUT = 300
+
+    def __init__(self, socket_path, start_timeout=None, idle_timeout=None):
+        self._socket_path = socket_path
+        self._start_timeout = start_timeout or self.START_TIMEOUT
+        self._idle_timeout = idle_timeout or self.IDLE_TIMEOUT
+
+    @classmethod
+    def from_config(cls, config_obj):
+        return cls(
+            socket_path(config_obj.salt_run_path),
+            start_timeout=getattr(config_obj, "daemon_start_timeout", None),
+            idle_timeout=getattr(config_obj, "worker_idle_timeout", None),
+        )
+
+    @staticmethod
+    def supports(arg_list):
+        if not hasattr(socket, "SO_PEERCRED"):
+            return False
+        return os.path.basename(arg_list[0]) in SCRIPTS
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    def _spawn(self):
+        args = [
+            sys.executable, "-m", __name__, "serve",
+            self._socket_path, str(self._idle_timeout),
+        ]
+        LOG.debug(f"Starting a salt worker on '{self._socket_path}'")
+        return subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def connect(self):
+        utils.private_dir(os.path.dirname(self._socket_path))
+        sock = self._connect()
+        if sock is not None:
+            return sock
+        proc = self._spawn()
+        deadline = time.monotonic() + self._start_timeout
+        delay = 0.005
+        while sock is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No salt worker on '{self._socket_path}'")
+            # exit status 0 means another worker holds the socket; keep waiting
+            if proc.poll():
+                raise RuntimeError(
+                    f"Salt worker (pid {proc.pid}) exited on startup: {proc.returncode}"
+                )
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
+            sock = self._connect()
+        return sock
+
+    def execute(self, arg_list, fds=STDIO):
+        try:
+            sock = self.connect()
+        except (TimeoutError, RuntimeError, OSError) as exc:
+            LOG.warning(f"No salt worker ({exc}). Running {arg_list} directly.")
+            return None
+        request = json.dumps(
+            {"argv": list(arg_list), "cwd": os.getcwd(), "env": dict(os.environ)}
+        ).encode()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = None
+        with sock, sock.makefile("rb") as replies:
+            try:
+                _send_fds(sock, HEADER.pack(len(request)), list(fds))
+                sock.sendall(request)
+                for line in replies:
+                    reply = json.loads(line)
+                    if "retcode" in reply:
+                        return reply["retcode"]
+                    pid = reply["pid"]
+            except KeyboardInterrupt:
+                if pid is not None:
+                    os.kill(pid, signal.SIGINT)
+                raise
+            except (OSError, ValueError, KeyError):
+                LOG.debug(f"Lost the worker on '{self._socket_path}'", exc_info=True)
+        if pid is None:
+            # the worker went idle before forking, so nothing ran
+            LOG.debug(f"Salt worker dropped {arg_list}. Running it directly.")
+            return None
+        LOG.error(f"Salt worker exited without a return code for {arg_list}")
+        return 1
+
+
+if __name__ == "__main__":
+    assert sys.argv[1] == "serve", sys.argv
+    path, idle_timeout = sys.argv[2:]
+    WorkerServer(path, float(idle_timeout)).serve()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from saltbox.api import SaltBox, SaltBoxConfig, call_async, run_async
+
+
+def sleeper(tmp_path, ignore_term=False):
+    pid_path = tmp_path / 'pid'
+    code = ('import os, signal, time\n'
+            + ('signal.signal(signal.SIGTERM, signal.SIG_IGN)\n' if ignore_term else '')
+            + f'open({str(pid_path)!r}, "w").write(str(os.getpid()))\n'
+            'time.sleep(60)\n')
+    return [sys.executable, '-c', code], pid_path
+
+async def started(pid_path):
+    while not pid_path.exists() or not pid_path.read_text():
+        await asyncio.sleep(0.01)
+    return int(pid_path.read_text())
+
+def assert_gone(pid):
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+@pytest.mark.parametrize('function', [call_async, run_async])
+def test_timeout_terminates_the_child(tmp_path, function):
+    args, pid_path = sleeper(tmp_path)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(function(args, timeout=1, grace=5))
+    assert_gone(int(pid_path.read_text()))
+
+def test_child_ignoring_sigterm_is_killed_after_grace(tmp_path):
+    args, pid_path = sleeper(tmp_path, ignore_term=True)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(call_async(args, timeout=1, grace=0.2))
+    assert_gone(int(pid_path.read_text()))
+
+@pytest.mark.parametrize('function', [call_async, run_async])
+def test_cancellation_terminates_the_child(tmp_path, function):
+    args, pid_path = sleeper(tmp_path)
+
+    async def cancel():
+        task = asyncio.ensure_future(function(args, grace=5))
+        pid = await started(pid_path)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return pid
+
+    assert_gone(asyncio.run(cancel()))
+
+def test_run_async_captures_output():
+    proc = asyncio.run(run_async([sys.executable, '-c', 'print("out")'],
+                                 capture_output=True))
+    assert (proc.returncode, proc.stdout) == (0, b'out\n')
+
+def test_executor_factory_is_an_async_context_manager(tmp_path):
+    config = SaltBoxConfig.from_env(prefix=str(tmp_path / 'prefix'),
+                                    bin_prefix=str(tmp_path / 'bin'))
+    os.makedirs(config.salt_config_path)
+    tool = tmp_path / 'bin' / 'tool'
+    tool.parent.mkdir()
+    tool.write_text(f'#!{sys.executable}\nimport sys\nprint(sys.argv[-1])\n')
+    tool.chmod(0o755)
+
+    async def main():
+        async with SaltBox.executor_factory(config) as api:
+            return await api.run_async('tool', 'a')
+
+    proc = asyncio.run(main())
+    assert (proc.returncode, proc.stdout) == (0, b'a\n')
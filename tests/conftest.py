@@ -7,4 +7,12 @@
     https://pytest.org/latest/plugins.html
 """
 
-# import pytest
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def host_ports_path(tmp_path, monkeypatch):
+    # keep PortAllocator's host-level file out of the real runtime dir
+    path = str(tmp_path / 'host-ports.json')
+    monkeypatch.setenv('SALTBOX_PORTS_PATH', path)
+    return path
@@ -0,0 +1,99 @@
+import datetime
+import json
+import shlex
+import subprocess
+
+import pytest
+
+from saltbox.api import Executor
+from saltbox.formula import CompiledFormula, Formula, Manifest, run_batch
+
+ARGS = [{'name': '--name', 'default': 'n1'}, {'name': '--msg', 'default': 'hello world'}]
+SALTARGS = {'pillar': '{{"a": "{name}"}}', 't': '1'}
+
+class RecordingApi:
+    def execute(self, *args):
+        return list(args)
+
+def format_then_split(cmd, saltargs, fields):
+    fields = dict(fields)
+    fields['saltargs'] = " ".join(f"{k}={v}" for k, v in saltargs.items()).format(**fields)
+    return [c for c in shlex.split(cmd.format(**fields)) if c != '\n']
+
+@pytest.mark.parametrize('cmd', [
+    'salt-call test.echo text="hello world" {saltargs}',
+    'salt-call test.arg foo="bar baz" {name}',
+    r'salt-call test.arg a\ b {name}',
+    'salt-call test.arg pre{name}"q r"',
+    'salt-call test.arg "{name}"suffix',
+    'salt-call test.arg "{msg}" {saltargs}',
+    "salt-call 'a b' {name}\n  next",
+    'salt-run x "pre {name} post" lit{{x}}',
+])
+def test_cmd_matches_format_then_split(cmd):
+    formula = Formula({'name': 'f', 'cmd': cmd, 'saltargs': SALTARGS, 'args': ARGS})
+    expected = format_then_split(cmd, SALTARGS, {'name': 'n1', 'msg': 'hello world'})
+    assert formula.run(RecordingApi()) == expected
+
+def test_compiled_formula_is_shared():
+    blob = {'name': 'f', 'cmd': 'x', 'args': []}
+    assert Formula(blob).compiled is Formula(dict(blob)).compiled
+    assert Formula(blob).parser is Formula(dict(blob)).parser
+
+def test_compiled_formula_accepts_yaml_dates():
+    blob = {'name': 'f', 'cmd': 'x {day}',
+            'args': [{'name': '--day', 'default': datetime.date(2020, 1, 1)}]}
+    assert Formula(blob).run(RecordingApi()) == ['x', '2020-01-01']
+
+def test_template_compiled_once():
+    blob = {'name': 'f', 'template': 'echo {{ saltbox.cli.name }}', 'args': ARGS}
+    assert Formula(blob).run(RecordingApi()) == ['echo', 'n1']
+    assert CompiledFormula.from_blob(blob).template is Formula(blob).compiled.template
+
+class BatchApi(Executor):
+    def __init__(self):
+        self.calls = []
+
+    def execute(self, *args):
+        self.calls.append(list(args))
+        return 0
+
+    def run(self, *args):
+        self.calls.append(list(args))
+        targets = args[3].split(',')
+        ret = {f'id_{t}': {'__sls__': t, 'result': t != 'bad'} for t in targets}
+        return subprocess.CompletedProcess(args, 0, json.dumps({'local': ret}).encode(), b'')
+
+def runner_formula(name, saltenv='base'):
+    return Formula({'name': name, 'runner': 'salt-call state.apply', 'saltenv': saltenv,
+                    'args': [{'name': '--x', 'default': '1'}]})
+
+def test_run_batch_keeps_input_order():
+    api = BatchApi()
+    cmd = Formula({'name': 'c', 'cmd': 'echo between', 'args': []})
+    invocations = [(runner_formula('a'), []), (runner_formula('bad'), []), (cmd, []),
+                   (runner_formula('d'), []), (runner_formula('e', 'dev'), []),
+                   (runner_formula('f'), ['--x', '2']), (runner_formula('g'), ['--x', '2'])]
+    results = run_batch(api, invocations)
+    assert [call[3] if call[0] == 'salt-call' else call for call in api.calls] == [
+        'a,bad', ['echo', 'between'], 'd', 'e', 'f,g']
+    assert [ret[0] for ret in results] == [0, 1, 0, 0, 0, 0, 0]
+    assert sorted(results[1][1]) == ['id_bad']
+
+def test_split_batch_shares_unattributed_states():
+    ret = {'id_a': {'__sls__': 'a', 'result': True},
+           'id_inc': {'__sls__': 'included', 'result': False}}
+    split = Executor._split_batch(ret, ['a', 'b'], 0)
+    assert split['a'] == (1, ret)
+    assert split['b'] == (1, {'id_inc': ret['id_inc']})
+
+def test_split_batch_passes_errors_through():
+    assert Executor._split_batch(['Rendering SLS failed'], ['a'], 1) == {
+        'a': (1, ['Rendering SLS failed'])}
+
+def test_manifest_builds_formulas_lazily(tmp_path):
+    manifest_path = tmp_path / 'saltbox.yaml'
+    manifest_path.write_text('name: b\nformulas:\n  - name: f1\n  - name: f2\n')
+    formulas = Manifest.from_path(str(manifest_path)).formulas
+    assert 'f1' in formulas and list(formulas) == ['f1', 'f2']
+    assert formulas['f1'] is formulas['f1']
@@ -0,0 +1,60 @@
+import sqlite3
+
+import pytest
+
+from saltbox.api import Registry, SaltBox, SaltBoxConfig
+
+
+def make_config(tmp_path, **dargs):
+    return SaltBoxConfig.from_env(prefix=str(tmp_path / 'prefix'),
+                                  bin_prefix=str(tmp_path / 'bin'),
+                                  **dargs)
+
+def make_root(tmp_path, name):
+    root = tmp_path / name
+    root.mkdir()
+    (root / 'a.sls').write_text('a: 1\n')
+    return str(root)
+
+def test_append_updates_a_registered_root_in_place(tmp_path):
+    registry = Registry.from_list([])
+    a, b = make_root(tmp_path, 'a'), make_root(tmp_path, 'b')
+    registry.append(a, fingerprint='1')
+    registry.append(b)
+    registry.append(a, fingerprint='2')
+    assert registry.template_roots == [a, b]
+    assert registry.metadata(a)['fingerprint'] == '2'
+
+def test_replace_keeps_position(tmp_path):
+    a, b, c = (make_root(tmp_path, name) for name in 'abc')
+    registry = Registry.from_list([a, b])
+    registry.replace(a, c)
+    assert registry.template_roots == [c, b]
+    registry.replace(c, b)
+    assert registry.template_roots == [b]
+
+def test_installer_only_locks_the_registry_to_write(tmp_path):
+    config = make_config(tmp_path)
+    with SaltBox.installer_factory(config) as api:
+        api.add_package(make_root(tmp_path, 'a'))
+    root = make_root(tmp_path, 'box')
+    with SaltBox.installer_factory(config) as api:
+        api.add_package(root)
+        other = sqlite3.connect(config.saltbox_registry_path, timeout=0,
+                                isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        other.execute('ROLLBACK')
+        other.close()
+    registry = Registry.from_file(config.saltbox_registry_path)
+    assert registry.template_roots[-1] == root
+
+def test_failed_install_leaves_the_registry_alone(tmp_path):
+    config = make_config(tmp_path)
+    with SaltBox.installer_factory(config) as api:
+        api.add_package(make_root(tmp_path, 'a'))
+    before = Registry.from_file(config.saltbox_registry_path).template_roots
+    with pytest.raises(RuntimeError):
+        with SaltBox.installer_factory(config) as api:
+            api.add_package(make_root(tmp_path, 'b'))
+            raise RuntimeError()
+    assert Registry.from_file(config.saltbox_registry_path).template_roots == before
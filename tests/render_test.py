@@ -0,0 +1,95 @@
+import os
+import stat
+
+import pytest
+
+from saltbox.api import TemplateRenderer
+from saltbox.template import RecipeTemplate
+
+
+def write(root, relpath, text):
+    path = root / relpath
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    # same-size rewrites within one mtime tick must still be seen as edits
+    os.utime(str(path), ns=(0, path.stat().st_mtime_ns + 1))
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    lower, upper = tmp_path / 'lower', tmp_path / 'upper'
+    write(lower, 'a.sls', 'a: {{$ X $}}\n')
+    write(lower, 'b.sls', 'b: {{$ X $}}\n')
+    write(lower, 'shadowed.sls', 'lower: {{$ X $}}\n')
+    write(lower, 'static.txt', 'static\n')
+    write(upper, 'shadowed.sls', 'upper: {{$ X $}}\n')
+    rendered = []
+    render_jobs = TemplateRenderer._render_jobs
+
+    def _render_jobs(jobs, *args, **dargs):
+        rendered.extend(relpath for _, relpath, _, _ in jobs)
+        return render_jobs(jobs, *args, **dargs)
+
+    monkeypatch.setattr(TemplateRenderer, '_render_jobs', _render_jobs)
+    salt_root, state_root = tmp_path / 'salt', tmp_path / 'state'
+
+    def render(x='1'):
+        del rendered[:]
+        TemplateRenderer.render_all([str(lower), str(upper)], str(salt_root),
+                                    str(state_root), extra_vars=dict(X=x))
+        return sorted(rendered)
+
+    render.lower, render.upper, render.salt_root = lower, upper, salt_root
+    return render
+
+def test_first_render_publishes_every_file(tree):
+    assert tree() == ['a.sls', 'b.sls', 'shadowed.sls', 'static.txt']
+    assert (tree.salt_root / 'a.sls').read_text() == 'a: 1'
+    assert (tree.salt_root / 'static.txt').read_text() == 'static\n'
+    assert tree() == []
+
+def test_editing_one_file_renders_only_that_file(tree):
+    tree()
+    write(tree.lower, 'a.sls', 'A: {{$ X $}}\n')
+    assert tree() == ['a.sls']
+    assert (tree.salt_root / 'a.sls').read_text() == 'A: 1'
+
+def test_editing_a_shadowed_file_renders_nothing(tree):
+    tree()
+    write(tree.lower, 'shadowed.sls', 'LOWER: {{$ X $}}\n')
+    assert tree() == []
+    assert (tree.salt_root / 'shadowed.sls').read_text() == 'upper: 1'
+
+def test_changing_vars_renders_everything(tree):
+    tree()
+    assert tree(x='2') == ['a.sls', 'b.sls', 'shadowed.sls', 'static.txt']
+    assert (tree.salt_root / 'b.sls').read_text() == 'b: 2'
+
+def test_missing_output_is_restored(tree):
+    tree()
+    (tree.salt_root / 'b.sls').unlink()
+    assert tree() == ['b.sls']
+    assert (tree.salt_root / 'b.sls').read_text() == 'b: 1'
+
+def test_later_roots_win_the_overlay(tree):
+    tree()
+    assert (tree.salt_root / 'shadowed.sls').read_text() == 'upper: 1'
+    (tree.upper / 'shadowed.sls').unlink()
+    assert tree() == ['shadowed.sls']
+    assert (tree.salt_root / 'shadowed.sls').read_text() == 'lower: 1'
+
+def test_render_many_streams_results_in_job_order(tmp_path):
+    for i in range(8):
+        write(tmp_path, f't{i}.sls', f't{i}: {{{{$ X $}}}}\n')
+    jobs = [(str(tmp_path), f't{i}.sls') for i in range(8)]
+    for workers in (1, 2):
+        rendered = RecipeTemplate.render_many(jobs, dict(X=1), workers=workers,
+                                              parallel_threshold=1)
+        assert next(rendered) == b't0: 1'
+        assert list(rendered) == [f't{i}: 1'.encode() for i in range(1, 8)]
+
+def test_chmod_republishes_the_file(tree):
+    tree()
+    path = tree.lower / 'static.txt'
+    os.chmod(str(path), 0o755)
+    assert tree() == ['static.txt']
+    assert stat.S_IMODE((tree.salt_root / 'static.txt').stat().st_mode) == 0o755
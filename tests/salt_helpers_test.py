@@ -0,0 +1,222 @@
+import os
+import socket
+import subprocess
+import threading
+import types
+
+import pytest
+
+from saltbox import salt_helpers, utils
+from saltbox.api import SaltBoxConfig, TemplateRenderer
+from saltbox.salt_helpers import (
+    DaemonSupervisor,
+    PidWaiter,
+    PortAllocator,
+    SaltDaemon,
+    load_opts,
+)
+
+
+def test_ports_are_unique_across_boxes_and_outside_ephemeral_range(tmp_path):
+    host_path = str(tmp_path / 'ports.json')
+    allocs = [PortAllocator(str(tmp_path / str(i)), host_path).ports()
+              for i in range(3)]
+    ports = [port for alloc in allocs for port in alloc.values()]
+    assert len(set(ports)) == len(ports)
+    assert all(port in PortAllocator.port_range() for port in ports)
+    assert PortAllocator(str(tmp_path / '0'), host_path).ports() == allocs[0]
+
+def test_recheck_moves_a_port_taken_by_another_process(tmp_path):
+    allocator = PortAllocator(str(tmp_path / 'box'), str(tmp_path / 'ports.json'))
+    ports = allocator.ports()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('', ports['PUBLISH_PORT']))
+        sock.listen()
+        assert allocator.ports() == ports
+        moved = allocator.ports(recheck=True)
+    assert moved['PUBLISH_PORT'] != ports['PUBLISH_PORT']
+    assert moved['RET_PORT'] == ports['RET_PORT']
+
+def test_runtime_dir_must_be_private(tmp_path, monkeypatch):
+    shared = tmp_path / 'run'
+    shared.mkdir()
+    os.chmod(str(shared), 0o777)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(shared))
+    with pytest.raises(PermissionError):
+        utils.private_dir(utils.runtime_dir())
+    os.chmod(str(shared), 0o700)
+    assert utils.private_dir(utils.runtime_dir()) == str(shared)
+
+def test_render_without_daemons_leaves_ports_alone(tmp_path, monkeypatch):
+    # an unusable host ports file must not matter when nothing binds a port
+    monkeypatch.delenv('SALTBOX_PORTS_PATH')
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'missing'))
+    config = SaltBoxConfig.from_env(prefix=str(tmp_path / 'prefix'),
+                                    bin_prefix=str(tmp_path / 'bin'))
+    with TemplateRenderer(config):
+        pass
+    state_root = config.saltbox_state_root
+    assert PortAllocator(state_root).allocated() == {}
+
+class StubDaemon(SaltDaemon):
+    EXE = 'stub'
+    PIDFILE = 'stub.pid'
+    SOCK_DIR = 'sock'
+    READY_SOCKETS = ('stub_*.ipc',)
+
+def sleeper(seconds):
+    # reaped in the background so the exit is not hidden behind a zombie
+    proc = subprocess.Popen(['sleep', str(seconds)])
+    threading.Thread(target=proc.wait, daemon=True).start()
+    return proc
+
+def dead_pid():
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+def stub_daemon(tmp_path, pid=None, sockets=()):
+    (tmp_path / 'sock').mkdir(exist_ok=True)
+    if pid is not None:
+        (tmp_path / 'stub.pid').write_text(str(pid))
+    for name in sockets:
+        (tmp_path / 'sock' / name).write_text('')
+    return StubDaemon(types.SimpleNamespace(salt_run_path=str(tmp_path)))
+
+@pytest.mark.parametrize('pidfd', [True, False])
+def test_pid_waiter_sees_the_exit(monkeypatch, pidfd):
+    if not pidfd:
+        monkeypatch.delattr(os, 'pidfd_open', raising=False)
+    proc = sleeper(0.3)
+    with PidWaiter(proc.pid) as waiter:
+        assert not waiter.wait(0)
+        assert waiter.wait(10)
+        assert waiter.wait(0)
+    with PidWaiter(dead_pid()) as waiter:
+        assert waiter.wait(0)
+
+def test_clear_stale_only_touches_a_dead_daemon(tmp_path):
+    daemon = stub_daemon(tmp_path, os.getpid(), ['stub_pub.ipc', 'other.ipc'])
+    daemon._clear_stale()
+    assert daemon.ready
+    daemon = stub_daemon(tmp_path, dead_pid())
+    daemon._clear_stale()
+    assert daemon.pid is None
+    assert os.listdir(str(tmp_path / 'sock')) == ['other.ipc']
+
+def test_wait_ready_returns_once_sockets_appear(tmp_path):
+    proc = sleeper(10)
+    daemon = stub_daemon(tmp_path, proc.pid)
+    timer = threading.Timer(0.1, stub_daemon, [tmp_path, None, ['stub_pub.ipc']])
+    timer.start()
+    try:
+        daemon._wait_ready(10)
+    finally:
+        timer.join()
+        proc.kill()
+
+def test_wait_ready_fails_fast_when_the_daemon_exits(tmp_path):
+    daemon = stub_daemon(tmp_path, sleeper(0.1).pid)
+    daemon._running = True
+    with pytest.raises(RuntimeError):
+        daemon._wait_ready(10)
+    assert not daemon.running
+
+def test_wait_ready_times_out(tmp_path):
+    with pytest.raises(TimeoutError):
+        stub_daemon(tmp_path, os.getpid())._wait_ready(0.2)
+    # no pidfile written yet
+    (tmp_path / 'stub.pid').unlink()
+    with pytest.raises(TimeoutError):
+        stub_daemon(tmp_path)._wait_ready(0.2)
+
+class FakeDaemon:
+    EXE = 'fake'
+
+    def __init__(self, config_obj):
+        self._config_obj = config_obj
+        self.up = False
+        self.events = []
+
+    def attach(self):
+        return self.up
+
+    def start(self):
+        self.up = True
+        self.events.append('start')
+
+    def stop(self):
+        self.up = False
+        self.events.append('stop')
+
+def supervisor(tmp_path, daemon=None, idle_timeout=None):
+    config = types.SimpleNamespace(salt_run_path=str(tmp_path),
+                                   salt_config_path=str(tmp_path / 'etc'))
+    return DaemonSupervisor(daemon or FakeDaemon(config), idle_timeout)
+
+def test_last_holder_stops_the_daemon(tmp_path):
+    first = supervisor(tmp_path)
+    second = supervisor(tmp_path, first.daemon)
+    first.acquire()
+    second.acquire()
+    assert first.daemon.events == ['start']
+    first.release()
+    assert first.daemon.up
+    second.release()
+    assert first.daemon.events == ['start', 'stop']
+
+def test_dead_holders_do_not_keep_the_daemon(tmp_path):
+    sup = supervisor(tmp_path)
+    sup.acquire()
+    sup._save([dead_pid(), os.getpid()])
+    sup.release()
+    assert sup.daemon.events == ['start', 'stop']
+
+def test_idle_reaper_stops_only_an_unclaimed_daemon(tmp_path, monkeypatch):
+    releases = []
+    monkeypatch.setattr(DaemonSupervisor, '_spawn_reaper',
+                        lambda self, released_at: releases.append(released_at))
+    sup = supervisor(tmp_path, idle_timeout=0.01)
+    sup.acquire()
+    sup.release()
+    assert sup.daemon.up
+    sup.acquire()
+    assert not sup.reap(releases[0])
+    sup.release()
+    assert not sup.reap(releases[0])
+    assert sup.daemon.up
+    assert sup.reap(releases[1])
+    assert sup.daemon.events == ['start', 'stop']
+
+@pytest.fixture
+def minion_loads(monkeypatch):
+    salt_config = pytest.importorskip('salt.config')
+    loads = []
+
+    def minion_config(path):
+        loads.append(path)
+        return {'loads': len(loads), 'nested': {}}
+
+    monkeypatch.setattr(salt_config, 'minion_config', minion_config)
+    monkeypatch.setattr(salt_helpers, '_OPTS_CACHE', {})
+    return loads
+
+def test_load_opts_reuses_a_copy_until_the_config_changes(tmp_path, minion_loads):
+    path = tmp_path / 'minion'
+    path.write_text('id: a\n')
+    opts = load_opts('minion', str(path))
+    opts['nested']['mutated'] = True
+    assert load_opts('minion', str(path)) == {'loads': 1, 'nested': {}}
+    os.utime(str(path), ns=(0, path.stat().st_mtime_ns + 1))
+    assert load_opts('minion', str(path))['loads'] == 2
+    assert minion_loads == [str(path)] * 2
+
+def test_load_opts_watches_the_include_dir(tmp_path, minion_loads):
+    path = tmp_path / 'minion'
+    path.write_text('id: a\n')
+    load_opts('minion', str(path))
+    (tmp_path / 'minion.d').mkdir()
+    assert load_opts('minion', str(path))['loads'] == 2
+    (tmp_path / 'minion.d' / 'extra.conf').write_text('b: 1\n')
+    assert load_opts('minion', str(path))['loads'] == 3
+    assert load_opts('minion', str(path))['loads'] == 3
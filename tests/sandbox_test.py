@@ -0,0 +1,45 @@
+import os
+
+from saltbox.formula import Box
+from saltbox.sandbox import SandboxPool
+
+MANIFEST = """name: b
+formulas:
+  - name: f1
+    runner: salt-call state.apply
+    saltenv: base
+    config: {}
+    args: []
+"""
+
+def make_box(tmp_path):
+    box_dir = tmp_path / 'box'
+    (box_dir / 'srv').mkdir(parents=True)
+    (box_dir / 'saltbox.yaml').write_text(MANIFEST)
+    (box_dir / 'srv' / 'a.sls').write_text('root: {{$ SALTROOT $}}\n')
+    return Box.from_path(str(box_dir))
+
+def test_checkout_resets_what_the_last_run_changed(tmp_path):
+    pool = SandboxPool(str(tmp_path / 'pool'))
+    box = make_box(tmp_path)
+    formula = box.manifest.formulas['f1']
+    with pool.sandbox(box, formula) as config:
+        prefix = config.salt_root_path
+        rendered = open(os.path.join(prefix, 'srv', 'a.sls')).read()
+        os.makedirs(os.path.join(prefix, 'var', 'cache', 'salt'))
+        open(os.path.join(prefix, 'var', 'cache', 'salt', 'x'), 'w').write('x')
+        open(os.path.join(prefix, 'srv', 'a.sls'), 'w').write('tampered')
+        open(os.path.join(prefix, 'srv', 'new.sls'), 'w').write('new')
+    with pool.sandbox(box, formula) as config:
+        assert config.salt_root_path == prefix
+        assert open(os.path.join(prefix, 'srv', 'a.sls')).read() == rendered
+        assert not os.path.exists(os.path.join(prefix, 'var', 'cache', 'salt'))
+        assert not os.path.exists(os.path.join(prefix, 'srv', 'new.sls'))
+        assert os.path.exists(config.saltbox_registry_path)
+
+def test_busy_slot_checks_out_another(tmp_path):
+    pool = SandboxPool(str(tmp_path / 'pool'))
+    box = make_box(tmp_path)
+    formula = box.manifest.formulas['f1']
+    with pool.sandbox(box, formula) as first, pool.sandbox(box, formula) as second:
+        assert first.salt_root_path != second.salt_root_path
@@ -0,0 +1,44 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+HERE = os.path.dirname(__file__)
+BUDGET_PATH = os.path.join(HERE, 'startup_budget.json')
+
+with open(BUDGET_PATH) as budget_file:
+    BUDGET = json.load(budget_file)
+
+def import_times(args):
+    # parses `python -X importtime` lines: "import time: self | cumulative | name"
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if not line.startswith('import time:') or not fields[0].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[0])
+    return times
+
+def best_total(args):
+    # best of a few runs to keep scheduler noise out of the total
+    return min(sum(import_times(args).values()) for _ in range(BUDGET['runs']))
+
+@pytest.mark.parametrize('command', BUDGET['commands'])
+def test_no_eager_imports(command):
+    times = import_times(['-m', 'saltbox'] + command.split())
+    eager = sorted(m for m in times if m.split('.')[0] in BUDGET['lazy'])
+    assert eager == [], f"saltbox {command} imports {eager} before dispatch"
+
+@pytest.mark.timing
+@pytest.mark.parametrize('command', BUDGET['commands'])
+def test_startup_budget(command):
+    # measured against a bare interpreter on the same host, not absolute time
+    baseline = best_total(['-c', 'pass'])
+    total = best_total(['-m', 'saltbox'] + command.split())
+    assert total <= BUDGET['max_ratio'] * baseline, \
+        f"saltbox {command} spent {total}us importing, {total / baseline:.1f}x " \
+        f"a bare interpreter (budget {BUDGET['max_ratio']}x)"
@@ -0,0 +1,64 @@
+import os
+import stat
+
+from saltbox.api import TemplateRenderer
+from saltbox.store import ContentStore
+
+
+def make_package(tmp_path):
+    package = tmp_path / 'package'
+    (package / 'bin').mkdir(parents=True)
+    (package / 'a.sls').write_text('a: {{$ SALTROOT $}}\n')
+    os.chmod(str(package / 'a.sls'), 0o644)
+    (package / 'bin' / 'run.sh').write_text('#!/bin/sh\n')
+    os.chmod(str(package / 'bin' / 'run.sh'), 0o755)
+    (package / 'static.txt').write_text('static\n')
+    os.chmod(str(package / 'static.txt'), 0o664)
+    return package
+
+def test_unchanged_package_reuses_its_tree(tmp_path):
+    package = make_package(tmp_path)
+    store = ContentStore(str(tmp_path / 'cache'))
+    tree_dir = store.add_tree(str(package))
+    assert store.tree_for(str(package)) == tree_dir
+    assert store.add_tree(str(package)) == tree_dir
+    (package / 'static.txt').write_text('edited\n')
+    assert store.add_tree(str(package)) != tree_dir
+
+def test_cached_objects_are_shared_and_read_only(tmp_path):
+    package = make_package(tmp_path)
+    store = ContentStore(str(tmp_path / 'cache'))
+    tree_dir = store.add_tree(str(package))
+    copy = tmp_path / 'copy'
+    os.rename(str(package), str(copy))
+    other_dir = store.add_tree(str(copy))
+    assert other_dir == tree_dir
+    assert not os.stat(os.path.join(tree_dir, 'static.txt')).st_mode & 0o222
+    (copy / 'static.txt').write_text('edited\n')
+    new_dir = store.add_tree(str(copy))
+    shared = os.stat(os.path.join(new_dir, 'a.sls'))
+    assert shared.st_ino == os.stat(os.path.join(tree_dir, 'a.sls')).st_ino
+
+def test_published_files_keep_source_modes_and_are_not_links(tmp_path):
+    package = make_package(tmp_path)
+    store = ContentStore(str(tmp_path / 'cache'))
+    tree_dir = store.add_tree(str(package))
+    salt_root = tmp_path / 'salt'
+    TemplateRenderer.render_all([tree_dir], str(salt_root), str(tmp_path / 'state'))
+    assert sorted(os.listdir(str(salt_root))) == ['a.sls', 'bin', 'static.txt']
+    for relpath, mode in [('a.sls', 0o644), ('bin/run.sh', 0o755),
+                          ('static.txt', 0o664)]:
+        published = os.stat(str(salt_root / relpath))
+        assert stat.S_IMODE(published.st_mode) == mode, relpath
+        assert published.st_nlink == 1, relpath
+
+def test_evict_keeps_registered_trees(tmp_path):
+    package = make_package(tmp_path)
+    store = ContentStore(str(tmp_path / 'cache'), max_bytes=1)
+    old_dir = store.add_tree(str(package))
+    (package / 'static.txt').write_text('edited\n')
+    new_dir = store.add_tree(str(package))
+    store.evict(keep=[new_dir])
+    assert not os.path.exists(old_dir)
+    assert os.path.isdir(new_dir)
+    assert store.tree_for(str(package)) == new_dir
@@ -0,0 +1,72 @@
+import os
+import sys
+
+from saltbox.api import Executor, OutputStream, SaltBoxConfig, stream
+
+WRITE = 'import os, sys, time\n'
+
+def script(body):
+    return [sys.executable, '-c', WRITE + body]
+
+def test_output_is_split_into_lines_per_stream():
+    seen = {'stdout': [], 'stderr': []}
+    proc = stream(script('sys.stdout.write("a\\nb"); sys.stdout.flush()\n'
+                         'time.sleep(0.1)\n'
+                         'sys.stdout.write("c\\nd")\n'
+                         'sys.stderr.write("e\\n")\n'),
+                  on_stdout=seen['stdout'].append, on_stderr=seen['stderr'].append)
+    with proc:
+        chunks = list(proc)
+        assert proc.returncode == 0
+        assert seen == {'stdout': [b'a\n', b'bc\n', b'd'], 'stderr': [b'e\n']}
+        assert sorted(chunks) == sorted(
+            [('stdout', line) for line in seen['stdout']]
+            + [('stderr', line) for line in seen['stderr']])
+        assert proc.stdout.read() == b'a\nbc\nd'
+        assert proc.stderr.read() == b'e\n'
+
+def test_long_lines_are_flushed_at_max_line(monkeypatch):
+    monkeypatch.setattr(OutputStream, 'MAX_LINE', 4)
+    with stream(script('sys.stdout.write("abcdefgh"); sys.stdout.flush()\n'
+                       'time.sleep(0.1)\n'
+                       'sys.stdout.write("ij\\nkl")\n')) as proc:
+        assert [data for _, data in proc] == [b'abcdefgh', b'ij\n', b'kl']
+
+def test_raw_chunks_skip_line_splitting():
+    with stream(script('sys.stdout.write("a\\nb")\n'), lines=False) as proc:
+        assert [data for _, data in proc] == [b'a\nb']
+
+def test_capture_spills_past_max_memory():
+    with stream(script('sys.stdout.write("x" * 100)\n'), max_memory=10) as proc:
+        assert proc.wait() == 0
+        assert proc.stdout._rolled
+        assert proc.stdout.read() == b'x' * 100
+        assert not proc.stderr._rolled
+    with stream(script('sys.stdout.write("x")\n'), capture=False) as proc:
+        assert proc.wait() == 0
+        assert proc.stdout is None
+
+def test_leaving_early_kills_the_process():
+    with stream(script('print(os.getpid(), flush=True)\n'
+                       'time.sleep(60)\n')) as proc:
+        for _, line in proc:
+            pid = int(line)
+            break
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        pass
+    else:
+        raise AssertionError(f"{pid} survived the stream")
+
+def test_executor_streams_the_formatted_command(tmp_path):
+    config = SaltBoxConfig.from_env(prefix=str(tmp_path / 'prefix'),
+                                    bin_prefix=str(tmp_path / 'bin'))
+    os.makedirs(config.salt_config_path)
+    tool = tmp_path / 'bin' / 'tool'
+    tool.parent.mkdir()
+    tool.write_text(f'#!{sys.executable}\nimport sys\nprint(*sys.argv[1:])\n')
+    tool.chmod(0o755)
+    with Executor(config).stream('tool', 'a') as proc:
+        assert list(proc) == [('stdout', b'--config-dir %s --log-level quiet a\n'
+                               % config.salt_config_path.encode())]
@@ -0,0 +1,78 @@
+import os
+
+from saltbox.template import TemplateIndex
+
+
+def make_index(tmp_path, files):
+    for relpath, text in files.items():
+        path = tmp_path / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    return TemplateIndex(str(tmp_path)).refresh()
+
+def touch(tmp_path, relpath, text):
+    path = tmp_path / relpath
+    path.write_text(text)
+    # same-size rewrites within one mtime tick must still be rescanned
+    os.utime(str(path), ns=(0, path.stat().st_mtime_ns + 1))
+
+FILES = {
+    'top.sls': '((* include "lib/a.sls" *)) {{$ X $}}\n',
+    'lib/a.sls': '((* include "lib/../lib/b.sls" *)) {{$ X $}}\n',
+    'lib/b.sls': 'b: {{$ X $}}\n',
+    'other.sls': 'other: {{$ X $}}\n',
+    'plain.txt': 'plain\n',
+}
+
+def test_dependencies_are_normalized(tmp_path):
+    index = make_index(tmp_path, FILES)
+    assert index.dependencies('top.sls') == ['lib/a.sls']
+    assert index.dependencies('lib/a.sls') == ['lib/b.sls']
+    assert index.dependencies('plain.txt') == []
+    assert index.graph == {'lib/a.sls': ['lib/b.sls'], 'top.sls': ['lib/a.sls']}
+
+def test_dependents_are_transitive(tmp_path):
+    index = make_index(tmp_path, FILES)
+    assert index.dependents('lib/b.sls') == {'lib/a.sls', 'top.sls'}
+    assert index.dependents('lib/a.sls') == {'top.sls'}
+    assert index.dependents('other.sls') == set()
+
+def test_include_edit_invalidates_its_includers_only(tmp_path):
+    index = make_index(tmp_path, FILES)
+    before = index.effective_digests()
+    touch(tmp_path, 'lib/b.sls', 'b: {{$ Y $}}\n')
+    after = index.refresh().effective_digests()
+    changed = {r for r in after if after[r] != before[r]}
+    assert changed == {'lib/b.sls', 'lib/a.sls', 'top.sls'}
+
+def test_dynamic_include_depends_on_every_file(tmp_path):
+    files = dict(FILES, **{'dyn.sls': '((* include NAME *)) {{$ X $}}\n'})
+    index = make_index(tmp_path, files)
+    assert index.dependencies('dyn.sls') == [None]
+    assert index.dependents('plain.txt') == {'dyn.sls'}
+    before = index.effective_digests()
+    touch(tmp_path, 'plain.txt', 'edited\n')
+    after = index.refresh().effective_digests()
+    changed = {r for r in after if after[r] != before[r]}
+    assert changed == {'plain.txt', 'dyn.sls'}
+
+def test_include_cycle_terminates(tmp_path):
+    index = make_index(tmp_path, {
+        'a.sls': '((* include "b.sls" *))\n',
+        'b.sls': '((* include "a.sls" *))\n',
+    })
+    digests = index.effective_digests()
+    assert set(digests) == {'a.sls', 'b.sls'}
+    assert index.dependents('a.sls') == {'b.sls'}
+
+def test_dynamic_includes_share_one_fingerprint(tmp_path, monkeypatch):
+    files = dict(FILES, **{'dyn1.sls': '((* include NAME *))\n',
+                           'dyn2.sls': '((* import NAME as n *))\n'})
+    index = make_index(tmp_path, files)
+    calls = []
+    fingerprint = TemplateIndex.fingerprint
+    monkeypatch.setattr(TemplateIndex, 'fingerprint', property(
+        lambda self: calls.append(1) or fingerprint.fget(self)))
+    digests = index.effective_digests()
+    assert digests['dyn1.sls'] != digests['dyn2.sls']
+    assert len(calls) == 1
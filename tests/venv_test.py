@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+from saltbox.venv import Venv
+
+MANIFEST = """name: {name}
+formulas:
+  - name: f1
+    descr: {descr}
+    runner: salt-call state.apply
+    saltenv: base
+    config: {{}}
+    args: []
+"""
+
+def bump(path):
+    # edits within one mtime tick must still invalidate the index
+    os.utime(str(path), ns=(0, path.stat().st_mtime_ns + 1))
+
+def add_box(site, name, descr='first'):
+    box_dir = site / name
+    (box_dir / 'srv').mkdir(parents=True, exist_ok=True)
+    (box_dir / 'saltbox.yaml').write_text(MANIFEST.format(name=name, descr=descr))
+    bump(box_dir / 'saltbox.yaml')
+    bump(site)
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    site = tmp_path / 'site'
+    site.mkdir()
+    add_box(site, 'b1')
+    monkeypatch.setattr(sys, 'prefix', str(tmp_path / 'prefix'))
+    monkeypatch.setattr(sys, 'path', [str(site), str(tmp_path / 'missing')])
+    return site
+
+def formulas(index):
+    return {name: entry['formulas'] for name, entry in index.items()}
+
+def test_index_is_built_and_written(site):
+    venv = Venv.from_env()
+    assert formulas(venv.index) == {'b1': [['f1', 'first']]}
+    assert venv.index['b1']['path'] == str(site / 'b1')
+    assert os.path.exists(venv.index_path)
+    assert venv.box('b1').name == 'b1'
+
+def test_fresh_index_is_reused(site, monkeypatch):
+    built = Venv.from_env().index
+    monkeypatch.setattr(Venv, '_build_index', lambda self: pytest.fail('rebuilt'))
+    assert Venv.from_env().index == built
+
+def test_new_box_on_the_path_invalidates_the_index(site):
+    Venv.from_env().index
+    add_box(site, 'b2')
+    assert sorted(Venv.from_env().index) == ['b1', 'b2']
+
+def test_edited_manifest_invalidates_the_index(site):
+    Venv.from_env().index
+    site_mtime = site.stat().st_mtime_ns
+    manifest = site / 'b1' / 'saltbox.yaml'
+    manifest.write_text(MANIFEST.format(name='b1', descr='second'))
+    bump(manifest)
+    assert site.stat().st_mtime_ns == site_mtime
+    assert formulas(Venv.from_env().index) == {'b1': [['f1', 'second']]}
@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+from saltbox import worker
+from saltbox.worker import WorkerClient, WorkerServer
+
+
+def fake_script():
+    # pytest swaps sys.stdout, so write to the fd the worker was handed
+    os.write(1, ' '.join(sys.argv[1:]).encode() + b'\n')
+    sys.exit(sys.argv[1] if sys.argv[1] == 'boom' else int(sys.argv[1]))
+
+@pytest.fixture
+def run_dir(tmp_path):
+    run = tmp_path / 'run'
+    run.mkdir(mode=0o700)
+    return run
+
+@pytest.fixture
+def server(run_dir, monkeypatch):
+    monkeypatch.setattr(worker, 'SCRIPTS', {'salt-call': f'{__name__}:fake_script'})
+    path = str(run_dir / 'w.sock')
+    proc = multiprocessing.get_context('fork').Process(
+        target=WorkerServer(path, 30).serve)
+    proc.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    yield path
+    proc.terminate()
+    proc.join()
+
+def execute(path, args, tmp_path):
+    out = tmp_path / 'out'
+    with open(os.devnull) as stdin, open(str(out), 'w') as stdout:
+        retcode = WorkerClient(path).execute(
+            args, fds=(stdin.fileno(), stdout.fileno(), stdout.fileno()))
+    return retcode, out.read_text()
+
+def test_round_trip_returns_the_script_exit_code(server, tmp_path):
+    assert execute(server, ['salt-call', '0', 'ok'], tmp_path) == (0, '0 ok\n')
+    assert execute(server, ['/bin/salt-call', '3'], tmp_path) == (3, '3\n')
+    assert execute(server, ['salt-call', 'boom'], tmp_path) == (1, 'boom\n')
+
+def test_dropped_request_falls_back(run_dir, tmp_path):
+    path = str(run_dir / 'w.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+
+    def drop():
+        conn, _ = listener.accept()
+        conn.close()
+
+    thread = threading.Thread(target=drop)
+    thread.start()
+    try:
+        assert execute(path, ['salt-call', '0'], tmp_path) == (None, '')
+    finally:
+        thread.join()
+        listener.close()
+
+def test_shared_socket_dir_falls_back(tmp_path, monkeypatch):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(str(shared), 0o777)
+    monkeypatch.setattr(WorkerClient, '_spawn', lambda self: pytest.fail('spawned'))
+    assert execute(str(shared / 'w.sock'), ['salt-call', '0'], tmp_path) == (None, '')
+
+def test_other_users_are_refused(run_dir, monkeypatch):
+    conn, peer = socket.socketpair()
+    assert worker._peer_uid(conn) == os.getuid()
+    monkeypatch.setattr(worker, '_peer_uid', lambda conn: os.getuid() + 1)
+    monkeypatch.setattr(os, 'fork', lambda: pytest.fail('forked'))
+    with peer:
+        with conn:
+            WorkerServer(str(run_dir / 'w.sock'), 30)._fork(conn)
+        assert peer.recv(1) == b''
+
+def test_socket_path_is_short_and_per_run_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    long_path = str(tmp_path / ('x' * 200))
+    path = worker.socket_path(long_path)
+    assert os.path.dirname(path) == str(tmp_path)
+    assert len(path) < len(str(tmp_path)) + 40
+    assert worker.socket_path(long_path) == path
+    assert worker.socket_path(long_path + 'y') != path